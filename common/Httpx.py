@@ -8,15 +8,18 @@
 # This file is part of the "lx-music-api-server" project.
 
 import aiohttp
-import requests
 import random
 import traceback
 import zlib
 import ujson as json
 import re
 import time
-import pickle
+import urllib.parse
+import asyncio
+import ssl
+import collections
 from . import log
+from . import metrics
 from . import config
 from . import utils
 from . import variable
@@ -26,13 +29,9 @@ def is_valid_utf8(text) -> bool:
         if isinstance(text, bytes):
             text = text.decode('utf-8')
         # 判断是否为有效的utf-8字符串
-        if "\ufffe" in text:
-            return False
-        try:
-            text.encode('utf-8').decode('utf-8')
-            return True
-        except UnicodeDecodeError:
-            return False
+        return "\ufffe" not in text
+    except UnicodeDecodeError:
+        return False
     except:
         logger.error(traceback.format_exc())
         return False
@@ -59,6 +58,28 @@ def log_plaintext(text: str) -> str:
             pass
     return text
 
+def describe_body(content: bytes):
+    # 将响应体转换为便于阅读的日志内容，开销较大，只在需要记录时调用
+    if (content.startswith(b'\x78\x9c') or content.startswith(b'\x78\x01')): # zlib headers
+        try:
+            content = zlib.decompress(content)
+        except:
+            return 'response is not text binary, ignore logging it'
+    if (is_valid_utf8(content)):
+        return log_plaintext(content.decode("utf-8"))
+    return 'response is not text binary, ignore logging it'
+
+def log_response(url: str, content: bytes):
+    '''
+    记录响应体，非调试模式下按common.http_body_sample的比例抽样记录
+    '''
+    if (logger.is_debug()):
+        logger.debug(lambda: describe_body(content))
+        return
+    rate = config.read_config('common.http_body_sample')
+    if (rate and random.random() < rate):
+        logger.info(f'响应抽样 {url}: {describe_body(content)}')
+
 # 内置的UA列表
 ua_list = [ 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36 Edg/112.0.1722.39',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1788.0',
@@ -71,134 +92,20 @@ ua_list = [ 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gec
 # 日志记录器
 logger = log.log('http_utils')
 
-def request(url: str, options = {}) -> requests.Response:
-    '''
-    Http请求主函数, 用于发送网络请求
-    - url: 需要请求的URL地址(必填)
-    - options: 请求的配置参数(可选, 留空时为GET请求, 总体与nodejs的请求的options填写差不多)
-        - method: 请求方法
-        - headers: 请求头
-        - body: 请求体(也可使用python原生requests库的data参数)
-        - form: 提交的表单数据
-        - cache: 缓存设置
-                - no-cache: 不缓存
-                - <int>: 缓存可用秒数
-        - cache-ignore: <list> 缓存忽略关键字
-    
-    @ return: requests.Response类型的响应数据
-    '''
-    # 缓存读取
-    cache_key = f'{url}{options}'
-    if (isinstance(options.get('cache-ignore'), list)):
-        for i in options.get('cache-ignore'):
-            cache_key = cache_key.replace(str(i), '')
-        options.pop('cache-ignore')
-    cache_key = utils.createMD5(cache_key)
-    if options.get("cache") and options["cache"] != "no-cache":
-        cache = config.getCache("httpx", cache_key)
-        if cache:
-            logger.debug(f"请求 {url} 有可用缓存")
-            return pickle.loads(utils.createBase64Decode(cache["data"]))
-    if "cache" in list(options.keys()):
-        cache_info = options.get("cache")
-        options.pop("cache")
-    else:
-        cache_info = None
-    
-
-    # 获取请求方法，没有则默认为GET请求
-    try:
-        method = options['method'].upper()
-        options.pop('method')
-    except Exception as e:
-        method = 'GET'
-    # 获取User-Agent，没有则从ua_list中随机选择一个
-    try:
-        d_lower = {k.lower(): v for k, v in options['headers'].items()}
-        useragent = d_lower['user-agent']
-    except:
-        try:
-            options['headers']['User-Agent'] = random.choice(ua_list)
-        except:
-            options['headers'] = {}
-            options['headers']['User-Agent'] = random.choice(ua_list)
-    # 检查是否在国内
-    if ((not variable.iscn) and (not options["headers"].get("X-Forwarded-For"))):
-        options["headers"]["X-Forwarded-For"] = variable.fakeip
-    # 获取请求主函数
-    try:
-        reqattr = getattr(requests, method.lower())
-    except AttributeError:
-        raise AttributeError('Unsupported method: '+method)
-    # 请求前记录
-    logger.debug(f'HTTP Request: {url}\noptions: {options}')
-    # 转换body/form参数为原生的data参数，并为form请求追加Content-Type头
-    if (method == 'POST') or (method == 'PUT'):
-        if options.get('body'):
-            options['data'] = options['body']
-            options.pop('body')
-        if options.get('form'):
-            options['data'] = convert_dict_to_form_string(options['form'])
-            options.pop('form')
-            options['headers']['Content-Type'] = 'application/x-www-form-urlencoded'
-        if (isinstance(options['data'], dict)):
-            options['data'] = json.dumps(options['data'])
-    # 进行请求
-    try:
-        logger.info("-----start----- " + url)
-        req = reqattr(url, **options)
-    except Exception as e:
-        logger.error(f'HTTP Request runs into an Error: {log.highlight_error(traceback.format_exc())}')
-        raise e
-    # 请求后记录
-    logger.debug(f'Request to {url} succeed with code {req.status_code}')
-    if (req.content.startswith(b'\x78\x9c') or req.content.startswith(b'\x78\x01')): # zlib headers
-        try:
-            decompressed = zlib.decompress(req.content)
-            if (is_valid_utf8(decompressed)):
-                logger.debug(log_plaintext(decompressed.decode("utf-8")))
-            else:
-                logger.debug('response is not text binary, ignore logging it')
-        except:
-            logger.debug('response is not text binary, ignore logging it')
-    else:
-        if (is_valid_utf8(req.content)):
-            logger.debug(log_plaintext(req.content.decode("utf-8")))
-        else:
-            logger.debug('response is not text binary, ignore logging it')
-    # 缓存写入
-    if (cache_info and cache_info != "no-cache"):
-        cache_data = pickle.dumps(req)
-        expire_time = (cache_info if isinstance(cache_info, int) else 3600) + int(time.time())
-        config.updateCache("httpx", cache_key, {"expire": True, "time": expire_time, "data": utils.createBase64Encode(cache_data)})
-        logger.debug("缓存已更新: " + url)
-    def _json():
-        return json.loads(req.content)
-    setattr(req, 'json', _json)
-    # 返回请求
-    return req
-
-
-def checkcn():
-    try:
-        req = request("https://mips.kugou.com/check/iscn?&format=json")
-        body = utils.CreateObject(req.json())
-        variable.iscn = bool(body.flag)
-        if (not variable.iscn):
-            variable.fakeip = config.read_config('common.fakeip')
-            logger.info(f"您在非中国大陆服务器({body.country})上启动了项目，已自动开启ip伪装")
-            logger.warning("此方式无法解决咪咕音乐的链接获取问题，您可以配置代理，服务器地址可在下方链接中找到\nhttps://hidemy.io/cn/proxy-list/?country=CN#list")
-    except Exception as e:
-        logger.warning('检查服务器位置失败，已忽略')
-        logger.warning(traceback.format_exc())
-
 class ClientResponse:
-    # 这个类为了方便aiohttp响应与requests响应的跨类使用，也为了解决pickle无法缓存的问题
+    # 读取完毕的aiohttp响应，连接释放后仍可使用，也可以直接写入缓存
     def __init__(self, status, content, headers):
         self.status = status
         self.content = content
         self.headers = headers
-        self.text = content.decode("utf-8", errors='ignore')
+        self._text = None
+
+    @property
+    def text(self):
+        # 大部分调用方只用json()或content，按需解码
+        if (self._text is None):
+            self._text = self.content.decode("utf-8", errors='ignore')
+        return self._text
     
     def json(self):
         return json.loads(self.content)
@@ -211,6 +118,256 @@ async def convert_to_requests_response(aiohttp_response) -> ClientResponse:
     
     return ClientResponse(status_code, content, headers)
 
+# 参与缓存key计算的请求参数
+CACHE_KEY_OPTIONS = ('headers', 'body', 'form', 'data', 'json', 'params')
+
+def _canonical(value, ignore):
+    # 转换为可稳定序列化的结构，去除缓存忽略关键字
+    if isinstance(value, dict):
+        return {str(k): _canonical(v, ignore) for k, v in value.items() if (str(v) not in ignore)}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v, ignore) for v in value]
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, str):
+        for i in ignore:
+            value = value.replace(i, '')
+        return value
+    if (value is None) or isinstance(value, (int, float, bool)):
+        return value
+    return str(value)
+
+def make_cache_key(method, url, options, ignore = []) -> str:
+    '''
+    生成上游响应缓存的key，与参数的先后顺序无关
+    '''
+    ignore = [str(i) for i in ignore]
+    return utils.createMD5(json.dumps([
+        method.upper(),
+        _canonical(url, ignore),
+        _canonical({k: options[k] for k in CACHE_KEY_OPTIONS if (k in options)}, ignore),
+    ], sort_keys = True))
+
+# 所有连接池共用的SSL上下文，避免每个连接重新加载证书
+ssl_context = ssl.create_default_context()
+# 连接池名称 -> ClientSession
+sessions = {}
+# 地址 -> 连接池名称，未列出的地址使用default连接池
+pool_hosts = {}
+# 需要预连接的(连接池名称, 协议://地址[:端口])
+warmup_origins = []
+
+def _pool_config(name):
+    conf = dict(config.read_config('common.http_pool.default') or {})
+    if (name != 'default'):
+        conf.update(config.read_config(f'common.http_pool.pools.{name}') or {})
+    return conf
+
+def load_pools():
+    '''
+    读取连接池配置，建立地址与连接池的对应关系
+    '''
+    pool_hosts.clear()
+    warmup_origins.clear()
+    for name, conf in (config.read_config('common.http_pool.pools') or {}).items():
+        for entry in (conf.get('hosts') or []):
+            # 可以带上实际请求使用的协议与端口，只填写域名时按https处理
+            parts = urllib.parse.urlsplit(entry if ('://' in entry) else 'https://' + entry)
+            if (not parts.hostname):
+                continue
+            pool_hosts[parts.hostname] = name
+            origin = f'{parts.scheme}://{parts.netloc}'
+            if ((name, origin) not in warmup_origins):
+                warmup_origins.append((name, origin))
+
+def get_session(host: str) -> aiohttp.ClientSession:
+    '''
+    获取负责该地址的连接池，首次使用时创建
+    '''
+    name = pool_hosts.get(host, 'default')
+    session = sessions.get(name)
+    if ((session is None) or session.closed):
+        conf = _pool_config(name)
+        connector = aiohttp.TCPConnector(
+            limit = conf.get('limit', 100),
+            limit_per_host = conf.get('limit_per_host', 0),
+            keepalive_timeout = conf.get('keepalive', 15),
+            ttl_dns_cache = conf.get('dns_ttl', 10),
+            ssl = ssl_context,
+        )
+        session = sessions[name] = aiohttp.ClientSession(connector = connector, trust_env = True)
+        if (name == 'default'):
+            variable.aioSession = session
+    return session
+
+async def _warmup_host(origin):
+    try:
+        # 只为建立连接(DNS、TCP与TLS握手)，不关心返回内容，连接在请求结束后回到连接池中
+        # 协议与端口需要与实际请求一致，否则预先建立的连接不会被复用
+        async with get_session(urllib.parse.urlsplit(origin).hostname).head(
+                origin + '/', allow_redirects = False, timeout = aiohttp.ClientTimeout(total = 5)):
+            pass
+        return True
+    except Exception as e:
+        logger.debug(f'预连接{origin}失败: {e}')
+        return False
+
+def _pool_enabled(name):
+    # 以平台命名的连接池在平台停止服务时不预连接
+    conf = (config.read_config('module') or {}).get(name)
+    return not (isinstance(conf, dict) and (conf.get('enable') is False))
+
+async def warmup():
+    '''
+    预先建立到各连接池地址的连接
+    '''
+    origins = [origin for name, origin in warmup_origins if (_pool_enabled(name))]
+    if (not origins):
+        return
+    results = await asyncio.gather(*[_warmup_host(origin) for origin in origins])
+    logger.debug(f'已预连接{sum(results)}/{len(origins)}个上游地址')
+
+async def close_sessions():
+    for session in list(sessions.values()):
+        if (not session.closed):
+            await session.close()
+    sessions.clear()
+    variable.aioSession = None
+
+class RetryBudget:
+    '''
+    重试预算，每个正常请求积累ratio次重试机会，最多积累max_tokens次
+    使重试与对冲请求的数量不超过正常请求的一定比例，上游故障时不会被重试放大
+    '''
+    def __init__(self):
+        self.tokens = None
+
+    def deposit(self):
+        max_tokens = config.read_config('common.http_retry.budget_max')
+        if (self.tokens is None):
+            self.tokens = max_tokens
+        self.tokens = min(max_tokens, self.tokens + config.read_config('common.http_retry.budget_ratio'))
+
+    def withdraw(self):
+        if ((self.tokens is None) or (self.tokens < 1)):
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LatencyTracker:
+    # 记录最近的请求耗时，用于计算对冲请求的等待时间
+    SAMPLES = 200
+    MIN_SAMPLES = 20
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen = self.SAMPLES)
+        self._p95 = None
+        self._added = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self._added += 1
+        # 每积累一批新样本再重新计算，避免每次请求都排序
+        if (self._added >= self.MIN_SAMPLES):
+            self._added = 0
+            ordered = sorted(self.samples)
+            self._p95 = ordered[int(len(ordered) * 0.95) - 1]
+
+    def p95(self):
+        return self._p95
+
+
+retry_budgets = collections.defaultdict(RetryBudget)
+latencies = collections.defaultdict(LatencyTracker)
+
+def _pop_policy(options):
+    idempotent = options.pop('idempotent', False)
+    timeout = options.pop('timeout', None)
+    retry = options.pop('retry', None)
+    hedge = options.pop('hedge', None)
+    if (idempotent):
+        timeout = config.read_config('common.http_retry.timeout') if (timeout is None) else timeout
+        retry = config.read_config('common.http_retry.retries') if (retry is None) else retry
+        hedge = True if (hedge is None) else hedge
+    return (timeout, retry or 0, bool(hedge))
+
+def _hedge_delay(host):
+    p95 = latencies[host].p95()
+    if (p95 is None):
+        return config.read_config('common.http_retry.hedge_delay')
+    return max(p95, config.read_config('common.http_retry.hedge_min_delay'))
+
+async def _attempt(reqattr, url, host, options, timeout):
+    start_time = time.perf_counter()
+    try:
+        logger.info("-----start----- " + url)
+        if (timeout):
+            options = dict(options, timeout = aiohttp.ClientTimeout(total = timeout))
+        req_ = await reqattr(url, **options)
+        # 为懒人提供的不用改代码移植的方法
+        # 才不是梓澄呢
+        req = await convert_to_requests_response(req_)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        metrics.upstream_total.inc(host, 'error')
+        metrics.upstream_duration.observe(time.perf_counter() - start_time, host)
+        logger.error('HTTP Request runs into an Error:\n' + traceback.format_exc())
+        raise e
+    duration = time.perf_counter() - start_time
+    metrics.upstream_total.inc(host, str(req.status))
+    metrics.upstream_duration.observe(duration, host)
+    latencies[host].add(duration)
+    return req
+
+async def _hedged(attempt, host):
+    first = asyncio.ensure_future(attempt())
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout = _hedge_delay(host))
+        if ((not done) and retry_budgets[host].withdraw()):
+            metrics.upstream_retries.inc(host, 'hedge')
+            tasks.append(asyncio.ensure_future(attempt()))
+        pending = set(tasks)
+        while (pending):
+            done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                # 有一个成功就使用，全部失败时抛出最后一个错误
+                if ((not task.exception()) or (not pending)):
+                    return task.result()
+    finally:
+        for task in tasks:
+            if (not task.done()):
+                task.cancel()
+
+async def _request_with_policy(reqattr, url, host, options, policy):
+    timeout, retry, hedge = policy
+    attempt = lambda: _attempt(reqattr, url, host, options, timeout)
+    if ((not retry) and (not hedge)):
+        return await attempt()
+    budget = retry_budgets[host]
+    budget.deposit()
+    tries = 0
+    while True:
+        error = None
+        try:
+            req = await (_hedged(attempt, host) if hedge else attempt())
+            if ((req.status < 500) or (tries >= retry)):
+                return req
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if (tries >= retry):
+                raise
+            error = e
+        if (not budget.withdraw()):
+            metrics.upstream_retries.inc(host, 'budget_exhausted')
+            if (error):
+                raise error
+            return req
+        tries += 1
+        metrics.upstream_retries.inc(host, 'retry')
+        logger.info(f'请求{url}失败，进行第{tries}次重试')
+
 async def AsyncRequest(url, options = {}) -> ClientResponse:
     '''
     Http异步请求主函数, 用于发送网络请求
@@ -218,30 +375,29 @@ async def AsyncRequest(url, options = {}) -> ClientResponse:
     - options: 请求的配置参数(可选, 留空时为GET请求, 总体与nodejs的请求的options填写差不多)
         - method: 请求方法
         - headers: 请求头
-        - body: 请求体(也可使用python原生requests库的data参数)
+        - body: 请求体(也可使用aiohttp的data参数)
         - form: 提交的表单数据
         - cache: 缓存设置
                 - no-cache: 不缓存
                 - <int>: 缓存可用秒数
         - cache-ignore: <list> 缓存忽略关键字
+        - idempotent: 请求可以重复发送时设为True，按common.http_retry中的默认值开启下面三项
+        - timeout: 单次尝试的超时时间(秒)
+        - retry: 出错或返回5xx时的重试次数
+        - hedge: 第一次尝试迟迟未返回时是否再发出一次请求，取先返回的结果
     
     @ return: common.Httpx.ClientResponse类型的响应数据
     '''
-    if (not variable.aioSession):
-        variable.aioSession = aiohttp.ClientSession(trust_env=True)
     # 缓存读取
-    cache_key = f'{url}{options}'
-    if (isinstance(options.get('cache-ignore'), list)):
-        for i in options.get('cache-ignore'):
-            cache_key = cache_key.replace(str(i), '')
-        options.pop('cache-ignore')
-    cache_key = utils.createMD5(cache_key)
+    cache_ignore = options.pop('cache-ignore', None)
+    cache_key = make_cache_key(options.get('method', 'GET'), url, options,
+                               cache_ignore if isinstance(cache_ignore, list) else [])
     if options.get("cache") and options["cache"] != "no-cache":
-        cache = config.getCache("httpx_async", cache_key)
+        cache = await config.getHttpCacheAsync(cache_key)
         if cache:
             logger.debug(f"请求 {url} 有可用缓存")
-            c = pickle.loads(utils.createBase64Decode(cache["data"]))
-            return c
+            status, headers, content = cache
+            return ClientResponse(status, content, headers)
     if "cache" in list(options.keys()):
         cache_info = options.get("cache")
         options.pop("cache")
@@ -268,13 +424,15 @@ async def AsyncRequest(url, options = {}) -> ClientResponse:
     # 检查是否在国内
     if ((not variable.iscn) and (not options["headers"].get("X-Forwarded-For"))):
         options["headers"]["X-Forwarded-For"] = variable.fakeip
+    policy = _pop_policy(options)
+    host = urllib.parse.urlsplit(url).hostname or ''
     # 获取请求主函数
     try:
-        reqattr = getattr(variable.aioSession, method.lower())
+        reqattr = getattr(get_session(host), method.lower())
     except AttributeError:
         raise AttributeError('Unsupported method: '+method)
     # 请求前记录
-    logger.debug(f'HTTP Request: {url}\noptions: {options}')
+    logger.debug(lambda: f'HTTP Request: {url}\noptions: {options}')
     # 转换body/form参数为原生的data参数，并为form请求追加Content-Type头
     if (method == 'POST') or (method == 'PUT'):
         if (options.get('body') is not None):
@@ -287,36 +445,14 @@ async def AsyncRequest(url, options = {}) -> ClientResponse:
         if (isinstance(options.get('data'), dict)):
             options['data'] = json.dumps(options['data'])
     # 进行请求
-    try:
-        logger.info("-----start----- " + url)
-        req_ = await reqattr(url, **options)
-    except Exception as e:
-        logger.error(f'HTTP Request runs into an Error: {log.highlight_error(traceback.format_exc())}')
-        raise e
+    req = await _request_with_policy(reqattr, url, host, options, policy)
     # 请求后记录
-    logger.debug(f'Request to {url} succeed with code {req_.status}')
-    # 为懒人提供的不用改代码移植的方法
-    # 才不是梓澄呢
-    req = await convert_to_requests_response(req_)
-    if (req.content.startswith(b'\x78\x9c') or req.content.startswith(b'\x78\x01')): # zlib headers
-        try:
-            decompressed = zlib.decompress(req.content)
-            if (is_valid_utf8(decompressed)):
-                logger.debug(log_plaintext(decompressed.decode("utf-8")))
-            else:
-                logger.debug('response is not text binary, ignore logging it')
-        except:
-            logger.debug('response is not text binary, ignore logging it')
-    else:
-        if (is_valid_utf8(req.content)):
-            logger.debug(log_plaintext(req.content.decode("utf-8")))
-        else:
-            logger.debug('response is not text binary, ignore logging it')
+    logger.debug(f'Request to {url} succeed with code {req.status}')
+    log_response(url, req.content)
     # 缓存写入
     if (cache_info and cache_info != "no-cache"):
-        cache_data = pickle.dumps(req)
         expire_time = (cache_info if isinstance(cache_info, int) else 3600) + int(time.time())
-        config.updateCache("httpx_async", cache_key, {"expire": True, "time": expire_time, "data": utils.createBase64Encode(cache_data)})
+        await config.updateHttpCacheAsync(cache_key, req.status, req.headers, req.content, expire_time)
         logger.debug("缓存已更新: " + url)
     # 返回请求
     return req
\ No newline at end of file
@@ -0,0 +1,125 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: auth.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# 用户名/key鉴权，users.db只在被外部(如db.sh)修改后才会重新读取
+
+import os
+import asyncio
+import sqlite3
+import threading
+from . import scheduler
+from .log import log
+
+logger = log('auth')
+
+DB_PATH = 'users.db'
+REFRESH_INTERVAL = 5
+
+
+class UserTable:
+    '''
+    users表在内存中的副本
+    通过文件状态与PRAGMA data_version判断数据库是否被其他连接修改过
+    '''
+    def __init__(self, path):
+        self.path = path
+        # (name -> key, key -> name)，整体替换保证读取方不会看到更新了一半的数据
+        self.table = None
+        self._conn = None
+        self._stat = None
+        self._data_version = None
+        self._lock = threading.Lock()
+
+    def _stat_file(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def changed(self):
+        if ((self._conn is None) or (self._stat_file() != self._stat)):
+            return True
+        # WAL模式下写入不一定会改变主文件的mtime，data_version可以覆盖这种情况
+        with self._lock:
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        return version != self._data_version
+
+    def reload(self):
+        with self._lock:
+            stat = self._stat_file()
+            if (stat is None):
+                raise sqlite3.OperationalError(f'{self.path} 不存在')
+            # 文件被替换时旧连接仍指向原来的inode，需要重新连接
+            if ((self._conn is None) or (self._stat is None) or (stat[0] != self._stat[0])):
+                if (self._conn):
+                    self._conn.close()
+                self._conn = sqlite3.connect(self.path, check_same_thread = False)
+            rows = self._conn.execute('SELECT name, key FROM users').fetchall()
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            users = {}
+            keys = {}
+            for name, key in rows:
+                users[name] = key
+                keys.setdefault(key, name)
+            self.table = (users, keys)
+            self._stat = stat
+            self._data_version = version
+        return len(users)
+
+
+table = UserTable(DB_PATH)
+
+
+def verify(user, key):
+    '''
+    验证用户名与key是否匹配
+
+    @ return: bool，用户数据未能载入时为None
+    '''
+    if (table.table is None):
+        return None
+    return (user in table.table[0]) and (table.table[0][user] == key)
+
+
+def user_by_key(key):
+    '''
+    根据key查找用户名
+
+    @ return: 用户名，不存在时为False，用户数据未能载入时为None
+    '''
+    if (table.table is None):
+        return None
+    return table.table[1].get(key, False)
+
+
+_load_failed = False
+
+
+def _reload_if_changed():
+    global _load_failed
+    try:
+        if (table.changed()):
+            count = table.reload()
+            logger.info(f'用户数据已重新载入，共{count}个用户')
+        _load_failed = False
+    except sqlite3.Error as e:
+        # 持续失败时只记录一次，避免每次轮询都刷屏
+        if (not _load_failed):
+            logger.error(f'用户数据载入失败: {e}')
+        _load_failed = True
+
+
+async def refresh():
+    # 数据库读取放到线程池中，不阻塞事件循环
+    await asyncio.get_event_loop().run_in_executor(None, _reload_if_changed)
+
+
+_reload_if_changed()
+scheduler.append('auth_refresh', refresh, REFRESH_INTERVAL, silent = True)
@@ -0,0 +1,157 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: breaker.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# 按平台熔断上游请求，上游持续出错或超时时直接返回失败，而不是让请求堆积
+
+import time
+import asyncio
+import collections
+from . import config
+from . import metrics
+from .exceptions import FailedException
+from .log import log
+
+logger = log('breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenException(FailedException):
+    # 熔断期间的请求直接以此错误结束
+    pass
+
+
+class CircuitBreaker:
+    '''
+    单个平台的熔断器
+    - closed: 正常放行，统计时间窗口内的错误率，超过阈值时熔断
+    - open: 直接拒绝，open_time秒后进入half_open
+    - half_open: 只放行少量试探请求，全部成功后恢复，任意一次失败则重新熔断
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        # (结束时间, 是否失败)
+        self.calls = collections.deque()
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.probe_successes = 0
+        self.rejected = 0
+
+    def _prune(self, now):
+        deadline = now - config.read_config('module.circuit_breaker.window')
+        while (self.calls and self.calls[0][0] < deadline):
+            _, failed = self.calls.popleft()
+            if (failed):
+                self.failures -= 1
+
+    def _transition(self, state):
+        self.state = state
+        if (state == OPEN):
+            self.opened_at = time.time()
+            logger.warning(f'{self.name}的上游请求错误过多，已暂停请求{config.read_config("module.circuit_breaker.open_time")}秒')
+        elif (state == HALF_OPEN):
+            logger.info(f'{self.name}的熔断时间已到，开始试探上游是否恢复')
+        else:
+            logger.info(f'{self.name}的上游已恢复')
+        self.calls.clear()
+        self.failures = 0
+        self.probes = 0
+        self.probe_successes = 0
+
+    def allow(self):
+        if (self.state == OPEN):
+            if (time.time() - self.opened_at < config.read_config('module.circuit_breaker.open_time')):
+                return False
+            self._transition(HALF_OPEN)
+        if (self.state == HALF_OPEN):
+            if (self.probes >= config.read_config('module.circuit_breaker.half_open_probes')):
+                return False
+            self.probes += 1
+        return True
+
+    def record(self, failed):
+        now = time.time()
+        if (self.state == HALF_OPEN):
+            if (failed):
+                self._transition(OPEN)
+                return
+            self.probe_successes += 1
+            if (self.probe_successes >= config.read_config('module.circuit_breaker.half_open_probes')):
+                self._transition(CLOSED)
+            return
+        if (self.state == OPEN):
+            # 熔断前已经发出的请求，结果不再影响状态
+            return
+        self.calls.append((now, failed))
+        if (failed):
+            self.failures += 1
+        self._prune(now)
+        total = len(self.calls)
+        if ((total >= config.read_config('module.circuit_breaker.min_requests')) and
+                (self.failures / total >= config.read_config('module.circuit_breaker.error_rate'))):
+            self._transition(OPEN)
+
+
+breakers = {}
+
+
+def get(name):
+    breaker = breakers.get(name)
+    if (breaker is None):
+        breaker = breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+async def call(name, factory):
+    '''
+    通过熔断器调用上游
+    - name: 熔断器名称，一般为平台名
+    - factory: 无参数的协程函数
+
+    超时与FailedException以外的错误计为失败，超过slow_call秒的请求即使成功也计为失败
+    FailedException说明上游已正常响应，不计为失败
+    '''
+    if (not config.read_config('module.circuit_breaker.enable')):
+        return await factory()
+    breaker = get(name)
+    if (not breaker.allow()):
+        breaker.rejected += 1
+        raise CircuitOpenException(f'{name}的上游服务暂时不可用，请稍后再试')
+    start_time = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(factory(), config.read_config('module.circuit_breaker.timeout'))
+    except asyncio.TimeoutError:
+        breaker.record(True)
+        raise FailedException('上游请求超时')
+    except FailedException:
+        breaker.record(False)
+        raise
+    except asyncio.CancelledError:
+        # 调用方取消时无法判断上游状态，只归还试探名额
+        if (breaker.state == HALF_OPEN):
+            breaker.probes -= 1
+        raise
+    except Exception:
+        breaker.record(True)
+        raise
+    breaker.record((time.perf_counter() - start_time) > config.read_config('module.circuit_breaker.slow_call'))
+    return result
+
+
+@metrics.register_collector
+def _collect_breakers():
+    return [('lx_circuit_breaker_state', 'gauge', 'Circuit breaker state per source (0 closed, 1 half-open, 2 open)', ('source',),
+             [((name, ), STATE_VALUES[b.state]) for name, b in list(breakers.items())]),
+            ('lx_circuit_breaker_rejected_total', 'counter', 'Calls rejected while the circuit was open', ('source',),
+             [((name, ), b.rejected) for name, b in list(breakers.items())])]
@@ -8,6 +8,7 @@
 # This file is part of the "lx-music-api-server" project.
 
 import ujson as json
+import asyncio
 import time
 import os
 import traceback
@@ -17,8 +18,17 @@ import shutil
 import ruamel.yaml as yaml_
 from . import variable
 from .log import log
+from .log import writer as log_writer
+from .log import set_debug_mode
 from . import default_config
+from . import scheduler
+from . import metrics
 import threading
+import heapq
+import copy
+import collections
+import concurrent.futures
+import zlib
 
 logger = log('config_manager')
 
@@ -36,13 +46,49 @@ def get_data_connection():
 local_cache = threading.local()
 
 
+def open_cache_connection():
+    conn = sqlite3.connect('./cache.db')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')
+    conn.execute('PRAGMA mmap_size=67108864')
+    conn.execute('PRAGMA busy_timeout=5000')
+    return conn
+
+
 def get_cache_connection():
     # 检查线程本地存储对象是否存在连接对象，如果不存在则创建一个新的连接对象
     if not hasattr(local_cache, 'connection'):
-        local_cache.connection = sqlite3.connect('./cache.db')
+        local_cache.connection = open_cache_connection()
     return local_cache.connection
 
 
+# UPSERT语法需要SQLite 3.24.0及以上，旧版本退回到INSERT OR REPLACE
+if (sqlite3.sqlite_version_info >= (3, 24, 0)):
+    CACHE_UPSERT_SQL = '''INSERT INTO cache (module, key, data, expires_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (module, key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at'''
+else:
+    CACHE_UPSERT_SQL = 'INSERT OR REPLACE INTO cache (module, key, data, expires_at) VALUES (?, ?, ?, ?)'
+# 上游响应缓存单独存放在http_cache表中，在内存缓存与统计中使用的命名空间
+HTTP_CACHE_MODULE = 'httpx_async'
+if (sqlite3.sqlite_version_info >= (3, 24, 0)):
+    HTTP_CACHE_UPSERT_SQL = '''INSERT INTO http_cache (key, status, headers, body, compressed, expires_at) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET status = excluded.status, headers = excluded.headers, body = excluded.body,
+compressed = excluded.compressed, expires_at = excluded.expires_at'''
+else:
+    HTTP_CACHE_UPSERT_SQL = 'INSERT OR REPLACE INTO http_cache (key, status, headers, body, compressed, expires_at) VALUES (?, ?, ?, ?, ?, ?)'
+# 超过这个大小的响应体会尝试压缩
+HTTP_CACHE_COMPRESS_MIN = 1024
+CACHE_SWEEP_BATCH = 500
+# 缓存删除记录的保留时间(秒)
+CACHE_PURGE_KEEP = 3600
+CACHE_READ_THREADS = 4
+# 写入队列的提交间隔(秒)与单批的最大条目数
+CACHE_WRITE_INTERVAL = 0.05
+CACHE_WRITE_BATCH = 200
+
+
 class ConfigReadException(Exception):
     pass
 
@@ -106,7 +152,122 @@ def save_data(config_data):
         logger.error(traceback.format_exc())
 
 
-def getCache(module, key):
+class _MemoryCacheEntry:
+    __slots__ = ('data', 'size', 'expires_at')
+
+    def __init__(self, data, size, expires_at):
+        self.data = data
+        self.size = size
+        self.expires_at = expires_at
+
+
+class MemoryCache:
+    '''
+    位于cache.db之前的进程内LRU缓存，同时限制条目数与估算的总大小
+    条目大小按序列化后的长度估算
+    '''
+    # 每个条目在长度之外额外计入的开销
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_entries = 0, max_size = 0):
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        self.configure(max_entries, max_size)
+
+    def configure(self, max_entries, max_size):
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_size = max_size
+            self._shrink()
+
+    def _shrink(self):
+        while (self.entries and (len(self.entries) > self.max_entries or self.size > self.max_size)):
+            _, entry = self.entries.popitem(last = False)
+            self.size -= entry.size
+
+    def get(self, module, key):
+        k = (module, key)
+        with self._lock:
+            entry = self.entries.get(k)
+            if (entry is None):
+                return None
+            if ((entry.expires_at is not None) and int(time.time()) >= entry.expires_at):
+                del self.entries[k]
+                self.size -= entry.size
+                return None
+            self.entries.move_to_end(k)
+            return entry.data
+
+    def set(self, module, key, data, length, expires_at = None):
+        size = length + self.ENTRY_OVERHEAD
+        if (self.max_entries <= 0 or size > self.max_size):
+            return
+        k = (module, key)
+        with self._lock:
+            old = self.entries.pop(k, None)
+            if (old):
+                self.size -= old.size
+            self.entries[k] = _MemoryCacheEntry(data, size, expires_at)
+            self.size += size
+            self._shrink()
+
+
+    def purge(self, module, match):
+        with self._lock:
+            keys = [k for k in self.entries if (k[0] == module and match(k[1]))]
+            for k in keys:
+                self.size -= self.entries.pop(k).size
+        return len(keys)
+
+
+memory_cache = MemoryCache()
+# 各命名空间的缓存命中统计：memory为内存命中，disk为cache.db命中，stale为返回了已过期的数据，miss为未命中
+cache_stats = {}
+
+
+def _count_cache(module, kind):
+    stats = cache_stats.get(module)
+    if (stats is None):
+        stats = cache_stats[module] = {'memory': 0, 'disk': 0, 'stale': 0, 'miss': 0}
+    stats[kind] += 1
+
+
+def stale_grace(module):
+    '''
+    获取缓存过期后仍然保留的时间(秒)，未开启时为0
+    '''
+    if (not read_config('common.cache.stale.enable')):
+        return 0
+    return int(read_config(f'common.cache.stale.grace.{module}') or 0)
+
+
+def is_cache_stale(data):
+    '''
+    判断缓存数据是否已经超过了记录的可用时间
+    '''
+    return bool(data.get('expire')) and int(time.time()) >= data['time']
+
+
+def _expires_at(data, grace = 0):
+    # 数据实际从缓存中删除的时间，在可用时间之后再保留一段宽限期
+    return (int(data['time']) + grace) if data.get('expire') else None
+
+
+def _lookup_cache_memory(module, key):
+    # 依次查找内存缓存、待写入与正在写入cache.db的数据
+    cache_data = memory_cache.get(module, key)
+    if (cache_data is not None):
+        return cache_data
+    now = int(time.time())
+    for writes in (pending_cache_writes, committing_cache_writes):
+        pending = writes.get((module, key))
+        if (pending and ((pending.expires_at is None) or now < pending.expires_at)):
+            return pending.data
+    return None
+
+
+def _read_cache_db(module, key):
     try:
         # 连接到数据库（如果数据库不存在，则会自动创建）
         conn = get_cache_connection()
@@ -114,128 +275,378 @@ def getCache(module, key):
         # 创建一个游标对象
         cursor = conn.cursor()
 
-        cursor.execute("SELECT data FROM cache WHERE module=? AND key=?",
-                       (module, key))
+        cursor.execute("SELECT data, expires_at FROM cache WHERE module = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                       (module, key, int(time.time())))
 
         result = cursor.fetchone()
         if result:
             cache_data = json.loads(result[0])
             cache_data["time"] = int(cache_data["time"])
-            if (not cache_data['expire']):
-                return cache_data
-            if (int(time.time()) < int(cache_data['time'])):
-                return cache_data
+            return cache_data, len(result[0]), result[1]
     except:
         pass
         # traceback.print_exc()
-    return False
+    return None
 
 
-def updateCache(module, key, data):
+def _read_http_cache_db(key):
     try:
-        # 连接到数据库（如果数据库不存在，则会自动创建）
         conn = get_cache_connection()
-
-        # 创建一个游标对象
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT data FROM cache WHERE module=? AND key=?", (module, key))
-        result = cursor.fetchone()
+        result = conn.execute('''SELECT status, headers, body, compressed, expires_at FROM http_cache
+WHERE key = ? AND expires_at > ?''', (key, int(time.time()))).fetchone()
         if result:
-            cursor.execute(
-                "UPDATE cache SET data = ? WHERE module = ? AND key = ?", (json.dumps(data), module, key))
-        else:
-            cursor.execute(
-                "INSERT INTO cache (module, key, data) VALUES (?, ?, ?)", (module, key, json.dumps(data)))
-        conn.commit()
+            status, headers, body, compressed, expires_at = result
+            body = zlib.decompress(body) if compressed else bytes(body)
+            return (status, json.loads(headers), body), len(body), expires_at
     except:
-        logger.error('缓存写入遇到错误…')
+        logger.error('上游响应缓存读取遇到错误…')
         logger.error(traceback.format_exc())
+    return None
 
 
-def resetRequestTime(ip):
-    config_data = load_data()
-    try:
+def _cache_result(module, cache_data, kind, allow_stale):
+    if (cache_data is None):
+        _count_cache(module, 'miss')
+        return False
+    if (is_cache_stale(cache_data)):
+        # 宽限期内的数据只返回给明确接受过期数据的调用方
+        if (not allow_stale):
+            _count_cache(module, 'miss')
+            return False
+        kind = 'stale'
+    _count_cache(module, kind)
+    return cache_data
+
+
+def _store_cache_read(module, key, result):
+    # cache.db中读到的数据放入内存缓存，result为读取函数返回的(数据, 长度, 过期时间)
+    if (not result):
+        return None
+    memory_cache.set(module, key, result[0], result[1], result[2])
+    return result[0]
+
+
+async def getCacheAsync(module, key, allow_stale = False):
+    '''
+    读取缓存，内存未命中时在读取线程池中查询cache.db
+    - allow_stale: 是否返回已超过可用时间但仍在宽限期内的数据，可通过is_cache_stale判断
+    '''
+    cache_data = _lookup_cache_memory(module, key)
+    if (cache_data is not None):
+        return _cache_result(module, cache_data, 'memory', allow_stale)
+    result = await asyncio.get_event_loop().run_in_executor(cache_read_executor, _read_cache_db, module, key)
+    return _cache_result(module, _store_cache_read(module, key, result), 'disk', allow_stale)
+
+
+async def updateCacheAsync(module, key, data, grace = None):
+    '''
+    写入缓存，内存缓存立即更新，cache.db的写入进入队列按批提交
+    - grace: 过期后继续保留的时间(秒)，默认使用common.cache.stale.grace中的配置
+    '''
+    dumped = json.dumps(data)
+    expires_at = _expires_at(data, stale_grace(module) if (grace is None) else grace)
+    memory_cache.set(module, key, data, len(dumped), expires_at)
+    _queue_cache_write(module, key, data, CACHE_UPSERT_SQL, (module, key, dumped, expires_at), expires_at)
+
+
+async def getHttpCacheAsync(key):
+    '''
+    读取上游响应缓存
+
+    @ return: (status, headers, body)，未命中时为False
+    '''
+    cache_data = _lookup_cache_memory(HTTP_CACHE_MODULE, key)
+    if (cache_data is not None):
+        _count_cache(HTTP_CACHE_MODULE, 'memory')
+        return cache_data
+    result = await asyncio.get_event_loop().run_in_executor(cache_read_executor, _read_http_cache_db, key)
+    cache_data = _store_cache_read(HTTP_CACHE_MODULE, key, result)
+    _count_cache(HTTP_CACHE_MODULE, 'miss' if (cache_data is None) else 'disk')
+    return False if (cache_data is None) else cache_data
+
+
+async def updateHttpCacheAsync(key, status, headers, body, expires_at):
+    '''
+    写入上游响应缓存，响应体以BLOB保存，较大的响应体会经过zlib压缩
+    '''
+    memory_cache.set(HTTP_CACHE_MODULE, key, (status, headers, body), len(body), expires_at)
+    stored, compressed = body, 0
+    if (len(body) >= HTTP_CACHE_COMPRESS_MIN):
+        c = zlib.compress(body, 6)
+        if (len(c) < len(body)):
+            stored, compressed = c, 1
+    _queue_cache_write(HTTP_CACHE_MODULE, key, (status, headers, body), HTTP_CACHE_UPSERT_SQL,
+                       (key, status, json.dumps(headers), stored, compressed, expires_at), expires_at)
+
+
+class _PendingCacheWrite:
+    __slots__ = ('data', 'sql', 'params', 'expires_at')
+
+    def __init__(self, data, sql, params, expires_at):
+        self.data = data
+        self.sql = sql
+        self.params = params
+        self.expires_at = expires_at
+
+
+# 缓存读取线程池，每个线程持有自己的cache.db连接
+cache_read_executor = concurrent.futures.ThreadPoolExecutor(max_workers = CACHE_READ_THREADS, thread_name_prefix = 'cache_reader')
+# 所有写入与清理都在同一个线程中进行，避免写锁竞争
+cache_write_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'cache_writer')
+# 等待写入的数据，(module, key) -> _PendingCacheWrite，同一个key的多次写入只保留最后一次
+pending_cache_writes = {}
+# 正在提交的一批数据，提交完成前仍可以从这里读到
+committing_cache_writes = {}
+_cache_writer_task = None
+_cache_write_pending = None
+_cache_batch_full = None
+
+
+def _queue_cache_write(module, key, data, sql, params, expires_at):
+    pending_cache_writes[(module, key)] = _PendingCacheWrite(data, sql, params, expires_at)
+    _start_cache_writer()
+    _cache_write_pending.set()
+    if (len(pending_cache_writes) >= CACHE_WRITE_BATCH):
+        _cache_batch_full.set()
+
+
+def _start_cache_writer():
+    global _cache_writer_task, _cache_write_pending, _cache_batch_full
+    if ((_cache_writer_task is not None) and (not _cache_writer_task.done())):
+        return
+    _cache_write_pending = asyncio.Event()
+    _cache_batch_full = asyncio.Event()
+    _cache_writer_task = asyncio.get_event_loop().create_task(_cache_writer())
+
+
+async def _cache_writer():
+    while True:
+        await _cache_write_pending.wait()
+        # 攒够一批或等待一个提交间隔后再写入
         try:
-            config_data['requestTime'][ip] = 0
-        except KeyError:
-            config_data['requestTime'] = {}
-            config_data['requestTime'][ip] = 0
-        save_data(config_data)
-    except:
-        logger.error('配置写入遇到错误…')
-        logger.error(traceback.format_exc())
+            await asyncio.wait_for(_cache_batch_full.wait(), CACHE_WRITE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        await flushCache()
 
 
-def updateRequestTime(ip):
+def _commit_cache_batch(batch):
+    statements = {}
+    for w in batch.values():
+        statements.setdefault(w.sql, []).append(w.params)
     try:
-        config_data = load_data()
-        try:
-            config_data['requestTime'][ip] = time.time()
-        except KeyError:
-            config_data['requestTime'] = {}
-            config_data['requestTime'][ip] = time.time()
-        save_data(config_data)
+        conn = get_cache_connection()
+        with conn:
+            for sql, params in statements.items():
+                conn.executemany(sql, params)
     except:
-        logger.error('配置写入遇到错误...')
+        logger.error('缓存写入遇到错误…')
         logger.error(traceback.format_exc())
 
 
-def getRequestTime(ip):
-    config_data = load_data()
+async def flushCache():
+    '''
+    立即将队列中的缓存写入cache.db
+    '''
+    global pending_cache_writes, committing_cache_writes
+    if (_cache_write_pending):
+        _cache_write_pending.clear()
+        _cache_batch_full.clear()
+    if (not pending_cache_writes):
+        return
+    batch = pending_cache_writes
+    pending_cache_writes = {}
+    committing_cache_writes = batch
     try:
-        value = config_data['requestTime'][ip]
-    except:
-        value = 0
-    return value
+        await asyncio.get_event_loop().run_in_executor(cache_write_executor, _commit_cache_batch, batch)
+    finally:
+        if (committing_cache_writes is batch):
+            committing_cache_writes = {}
+
+
+def _sweep_cache():
+    conn = get_cache_connection()
+    now = int(time.time())
+    total = 0
+    # 删除记录只需要保留到所有worker都读取过为止
+    conn.execute('DELETE FROM cache_purges WHERE time <= ?', (now - CACHE_PURGE_KEEP, ))
+    conn.commit()
+    for table in ('cache', 'http_cache'):
+        while True:
+            cursor = conn.execute(f'''DELETE FROM {table} WHERE rowid IN
+(SELECT rowid FROM {table} WHERE expires_at <= ? LIMIT ?)''', (now, CACHE_SWEEP_BATCH))
+            conn.commit()
+            total += cursor.rowcount
+            if (cursor.rowcount < CACHE_SWEEP_BATCH):
+                break
+    return total
+
+
+def _purge_cache_db(module, key, exact):
+    conn = get_cache_connection()
+    with conn:
+        if (exact):
+            cursor = conn.execute("DELETE FROM cache WHERE module = ? AND key = ?", (module, key))
+        elif (not key):
+            cursor = conn.execute("DELETE FROM cache WHERE module = ?", (module, ))
+        else:
+            # 按区间匹配前缀，与内存中的startswith一样区分大小写(LIKE不区分)，也可以使用(module, key)索引
+            cursor = conn.execute("DELETE FROM cache WHERE module = ? AND key >= ? AND key < ?",
+                                  (module, key, key + '\U0010ffff'))
+        if (variable.worker_id is not None):
+            conn.execute('INSERT INTO cache_purges (module, key, exact, time) VALUES (?, ?, ?, ?)',
+                         (module, key, 1 if (exact) else 0, int(time.time())))
+    return cursor.rowcount
+
+
+def _purge_memory(module, key, exact):
+    match = (lambda k: k == key) if (exact) else (lambda k: k.startswith(key))
+    memory_cache.purge(module, match)
+    for k in [k for k in pending_cache_writes if (k[0] == module and match(k[1]))]:
+        del pending_cache_writes[k]
+
+
+async def purgeCacheAsync(module, key = '', exact = False):
+    '''
+    删除一个命名空间中的缓存
+    - module: 缓存命名空间
+    - key: exact为False时为key前缀，为空时删除整个命名空间
+    - exact: 只删除key完全相同的缓存
+
+    多进程模式下其它worker会在sync_cache_purges的下一次执行时清除各自内存中的缓存
+
+    @ return: cache.db中删除的条数
+    '''
+    _purge_memory(module, key, exact)
+    # 与写入在同一个线程中执行，正在提交的数据会先写入再被删除
+    return await asyncio.get_event_loop().run_in_executor(cache_write_executor, _purge_cache_db, module, key, exact)
+
+
+# 已处理的最后一条缓存删除记录，None表示尚未读取
+_last_cache_purge = None
+
+
+def _read_cache_purges(after):
+    conn = get_cache_connection()
+    if (after is None):
+        # 启动时内存中还没有缓存，只需要记录当前位置
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM cache_purges').fetchone()[0], []
+    rows = conn.execute('SELECT id, module, key, exact FROM cache_purges WHERE id > ? ORDER BY id', (after, )).fetchall()
+    return (rows[-1][0] if (rows) else after), rows
+
+
+async def sync_cache_purges():
+    '''
+    应用其它worker删除的缓存，只在多进程模式下运行
+    '''
+    global _last_cache_purge
+    last, rows = await asyncio.get_event_loop().run_in_executor(cache_read_executor, _read_cache_purges, _last_cache_purge)
+    _last_cache_purge = last
+    for _, module, key, exact in rows:
+        _purge_memory(module, key, bool(exact))
+
+
+async def sweep_cache():
+    # 分批删除过期的缓存，在写入线程中进行，不阻塞事件循环
+    total = await asyncio.get_event_loop().run_in_executor(cache_write_executor, _sweep_cache)
+    if (total):
+        logger.info(f'已清理{total}条过期缓存')
+
+
+@metrics.register_collector
+def _collect_cache_stats():
+    samples = []
+    for module, stats in list(cache_stats.items()):
+        for kind, value in stats.items():
+            samples.append(((module, kind), value))
+    return [('lx_cache_lookups_total', 'counter', 'Cache lookups by namespace and result (memory, disk or miss)', ('namespace', 'result'), samples),
+            ('lx_memory_cache_entries', 'gauge', 'Entries in the in-process cache tier', (), [((), len(memory_cache.entries))]),
+            ('lx_memory_cache_bytes', 'gauge', 'Estimated size of the in-process cache tier', (), [((), memory_cache.size)])]
+
+
+async def report_cache_stats():
+    for module, stats in cache_stats.items():
+        total = sum(stats.values())
+        if (total == 0):
+            continue
+        hit_ratio = (total - stats['miss']) / total * 100
+        logger.info(f'缓存({module})命中率: {hit_ratio:.1f}%，内存命中{stats["memory"]}次，cache.db命中{stats["disk"]}次，返回过期数据{stats["stale"]}次，未命中{stats["miss"]}次')
 
 
 def read_data(key):
     config = load_data()
     keys = key.split('.')
     value = config
-    for k in keys:
-        if k not in value and keys.index(k) != len(keys) - 1:
+    last = len(keys) - 1
+    for i, k in enumerate(keys):
+        if k not in value and i != last:
             value[k] = {}
-        elif k not in value and keys.index(k) == len(keys) - 1:
+        elif k not in value and i == last:
             value = None
         value = value[k]
 
     return value
 
 
-def write_data(key, value):
-    config = load_data()
+def update_data(key, func):
+    '''
+    在同一个事务中读取、修改并写回data.db中的一项，多个进程同时写入时不会互相覆盖
+    - key: data表中的键，即点分路径的第一段
+    - func: 接收旧值(不存在时为None)并返回新值的函数
 
-    keys = key.split('.')
-    current = config
+    @ return: 写入的新值
+    '''
+    conn = get_data_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT value FROM data WHERE key = ?', (key, )).fetchone()
+        value = func(json.loads(row[0]) if (row) else None)
+        conn.execute('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+        conn.commit()
+        return value
+    except:
+        conn.rollback()
+        raise
+
+
+def _set_path(root, keys, func):
+    current = root
     for k in keys[:-1]:
         if k not in current:
             current[k] = {}
         current = current[k]
+    current[keys[-1]] = func(current.get(keys[-1]))
 
-    current[keys[-1]] = value
 
-    save_data(config)
+def write_data(key, value):
+    keys = key.split('.')
+    if (len(keys) == 1):
+        update_data(key, lambda _: value)
+        return
 
+    def _update(old):
+        root = old if (isinstance(old, dict)) else {}
+        _set_path(root, keys[1:], lambda _: value)
+        return root
+    update_data(keys[0], _update)
 
-def push_to_list(key, obj):
-    config = load_data()
 
+def push_to_list(key, obj):
     keys = key.split('.')
-    current = config
-    for k in keys[:-1]:
-        if k not in current:
-            current[k] = {}
-        current = current[k]
 
-    if keys[-1] not in current:
-        current[keys[-1]] = []
+    def _push(current):
+        current = current if (isinstance(current, list)) else []
+        current.append(obj)
+        return current
+    if (len(keys) == 1):
+        update_data(key, _push)
+        return
 
-    current[keys[-1]].append(obj)
-
-    save_data(config)
+    def _update(old):
+        root = old if (isinstance(old, dict)) else {}
+        _set_path(root, keys[1:], _push)
+        return root
+    update_data(keys[0], _update)
 
 
 def write_config(key, value):
@@ -260,6 +671,89 @@ def write_config(key, value):
     # 写入配置并保留注释和空行
     with open('./config/config.yml', 'w', encoding='utf-8') as f:
         y.dump(config, f)
+    _remember_config_mtime()
+
+    # 同步到内存中的配置并重建快照
+    current = variable.config
+    for k in keys[:-1]:
+        if (not isinstance(current.get(k), dict)):
+            current[k] = {}
+        current = current[k]
+    current[keys[-1]] = copy.deepcopy(value)
+    build_config_snapshot()
+    apply_log_settings()
+
+
+# 最近一次载入或写入配置文件时的修改时间，多进程模式下用于发现其它进程写入的配置
+_config_mtime = None
+
+
+def _remember_config_mtime():
+    global _config_mtime
+    try:
+        _config_mtime = os.stat('./config/config.yml').st_mtime_ns
+    except OSError:
+        _config_mtime = None
+
+
+def apply_log_settings():
+    '''
+    使日志相关的配置生效，载入或修改配置文件后调用
+    '''
+    variable.log_length_limit = read_config('common.log_length_limit') or 500
+    variable.debug_mode = bool(read_config('common.debug_mode')) or (os.getenv('CURRENT_ENV') == 'development')
+    rotate = read_config('common.log_rotate')
+    rotate = rotate if (isinstance(rotate, dict)) else {}
+    log_writer.max_size = int((rotate.get('max_size') or 0) * 1024 * 1024)
+    log_writer.backup_count = int(rotate.get('backup_count') or 0)
+    set_debug_mode(variable.debug_mode)
+
+
+async def reload_config():
+    '''
+    配置文件被其它进程(如leader中的刷新登录)修改后重新载入
+    '''
+    try:
+        mtime = os.stat('./config/config.yml').st_mtime_ns
+    except OSError:
+        return
+    if (mtime == _config_mtime):
+        return
+    _remember_config_mtime()
+    try:
+        with open('./config/config.yml', 'r', encoding='utf-8') as f:
+            loaded = yaml.load(f.read())
+    except:
+        logger.warning('重新载入配置文件失败，继续使用当前的配置')
+        return
+    if (isinstance(loaded, dict)):
+        variable.config = loaded
+        build_config_snapshot()
+        apply_log_settings()
+        logger.info('配置文件已被修改，已重新载入')
+
+
+# 配置快照：点分路径 -> 值，读取配置时只需一次字典查询
+# 加载配置与write_config后整体重建并替换引用
+config_snapshot = {}
+
+
+def _flatten_config(value, prefix, result):
+    for k, v in value.items():
+        if (not isinstance(k, str)):
+            continue
+        path = prefix + k
+        result[path] = v
+        if (isinstance(v, dict)):
+            _flatten_config(v, path + '.', result)
+
+
+def build_config_snapshot():
+    global config_snapshot
+    snapshot = {}
+    if (isinstance(variable.config, dict)):
+        _flatten_config(variable.config, '', snapshot)
+    config_snapshot = snapshot
 
 
 def read_default_config(key):
@@ -267,11 +761,12 @@ def read_default_config(key):
         config = default
         keys = key.split('.')
         value = config
-        for k in keys:
+        last = len(keys) - 1
+        for i, k in enumerate(keys):
             if isinstance(value, dict):
-                if k not in value and keys.index(k) != len(keys) - 1:
+                if k not in value and i != last:
                     value[k] = {}
-                elif k not in value and keys.index(k) == len(keys) - 1:
+                elif k not in value and i == last:
                     value = None
                 value = value[k]
             else:
@@ -288,11 +783,12 @@ def _read_config(key):
         config = variable.config
         keys = key.split('.')
         value = config
-        for k in keys:
+        last = len(keys) - 1
+        for i, k in enumerate(keys):
             if isinstance(value, dict):
-                if k not in value and keys.index(k) != len(keys) - 1:
+                if k not in value and i != last:
                     value[k] = None
-                elif k not in value and keys.index(k) == len(keys) - 1:
+                elif k not in value and i == last:
                     value = None
                 value = value[k]
             else:
@@ -305,21 +801,27 @@ def _read_config(key):
 
 
 def read_config(key):
+    try:
+        return config_snapshot[key]
+    except KeyError:
+        pass
     try:
         config = variable.config
         keys = key.split('.')
         value = config
-        for k in keys:
+        last = len(keys) - 1
+        for i, k in enumerate(keys):
             if isinstance(value, dict):
-                if k not in value and keys.index(k) != len(keys) - 1:
+                if k not in value and i != last:
                     value[k] = {}
-                elif k not in value and keys.index(k) == len(keys) - 1:
+                elif k not in value and i == last:
                     value = None
                 value = value[k]
             else:
                 value = None
                 break
 
+        config_snapshot[key] = value
         return value
     except:
         default_value = read_default_config(key)
@@ -334,21 +836,69 @@ def read_config(key):
                     write_config(tk, read_default_config(tk))
                     logger.info(f'配置文件{tk}不存在，已创建')
                     return default_value
+        # 不存在的配置也记入快照，之后的读取不再重复查找与警告，配置被修改时快照会重建
+        config_snapshot[key] = default_value
+        return default_value
 
 
-def write_data(key, value):
-    config = load_data()
-
-    keys = key.split('.')
-    current = config
-    for k in keys[:-1]:
-        if k not in current:
-            current[k] = {}
-        current = current[k]
-
-    current[keys[-1]] = value
-
-    save_data(config)
+def create_cache_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS cache
+(module TEXT NOT NULL,
+key TEXT NOT NULL,
+data TEXT NOT NULL,
+expires_at INTEGER)''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS cache_module_key ON cache (module, key)')
+    conn.execute('CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS http_cache
+(key TEXT PRIMARY KEY,
+status INTEGER NOT NULL,
+headers TEXT NOT NULL,
+body BLOB NOT NULL,
+compressed INTEGER NOT NULL DEFAULT 0,
+expires_at INTEGER NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS http_cache_expires_at ON http_cache (expires_at)')
+    # 多进程模式下的缓存删除记录，其它worker据此清除自己内存中的缓存
+    conn.execute('''CREATE TABLE IF NOT EXISTS cache_purges
+(id INTEGER PRIMARY KEY AUTOINCREMENT,
+module TEXT NOT NULL,
+key TEXT NOT NULL,
+exact INTEGER NOT NULL,
+time INTEGER NOT NULL)''')
+    # 旧版本以pickle+base64的形式把上游响应存在cache表中，已不再读取
+    conn.execute("DELETE FROM cache WHERE module = 'httpx_async'")
+    conn.commit()
+
+
+def migrate_cache_table(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(cache)').fetchall()]
+    if ((not columns) or ('expires_at' in columns)):
+        return
+    logger.info('检测到旧版缓存数据库，正在迁移...')
+    conn.execute('ALTER TABLE cache RENAME TO cache_legacy')
+    create_cache_table(conn)
+    now = int(time.time())
+    # 按id顺序写入，重复的key以最后一次写入的为准
+    cursor = conn.execute('SELECT module, key, data FROM cache_legacy ORDER BY id')
+    while True:
+        rows = cursor.fetchmany(1000)
+        if (not rows):
+            break
+        batch = []
+        for module, key, data in rows:
+            try:
+                d = json.loads(data)
+                expires_at = int(d['time']) if d.get('expire') else None
+            except:
+                continue
+            if ((expires_at is not None) and expires_at <= now):
+                continue
+            batch.append((module, key, data, expires_at))
+        conn.executemany('INSERT OR REPLACE INTO cache (module, key, data, expires_at) VALUES (?, ?, ?, ?)', batch)
+    count = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+    conn.execute('DROP TABLE cache_legacy')
+    conn.commit()
+    conn.execute('VACUUM')
+    logger.info(f'缓存数据库迁移完成，保留了{count}条未过期的缓存')
 
 
 def initConfig():
@@ -384,20 +934,15 @@ def initConfig():
     except FileNotFoundError:
         variable.config = handle_default_config()
     # print(variable.config)
-    variable.log_length_limit = read_config('common.log_length_limit')
-    variable.debug_mode = read_config('common.debug_mode')
+    build_config_snapshot()
+    _remember_config_mtime()
+    apply_log_settings()
     logger.debug("配置文件加载成功")
-    conn = sqlite3.connect('./cache.db')
-
-    # 创建一个游标对象
-    cursor = conn.cursor()
+    conn = open_cache_connection()
 
-    # 创建一个表来存储缓存数据
-    cursor.execute('''CREATE TABLE IF NOT EXISTS cache
-(id INTEGER PRIMARY KEY AUTOINCREMENT,
-module TEXT NOT NULL,
-key TEXT NOT NULL,
-data TEXT NOT NULL)''')
+    # 旧版的cache表没有索引与过期时间列，需要迁移
+    migrate_cache_table(conn)
+    create_cache_table(conn)
 
     conn.close()
 
@@ -414,6 +959,10 @@ value TEXT)''')
 
     logger.debug('数据库初始化成功')
 
+    if (read_config('common.cache.memory.enable')):
+        memory_cache.configure(int(read_config('common.cache.memory.max_entries')),
+                               int(read_config('common.cache.memory.max_size') * 1024 * 1024))
+
     # handle data
     all_data_keys = {'banList': [], 'requestTime': {}, 'banListRaw': []}
     data = load_data()
@@ -445,43 +994,117 @@ value TEXT)''')
         logger.info('所以即使某个源你只有一个cookie，也请填写到cookiepool对应的源中，否则将无法使用该cookie')
         variable.use_cookie_pool = True
 
-    # 移除已经过期的封禁数据
-    banlist = read_data('banList')
-    banlistRaw = read_data('banListRaw')
-    count = 0
-    for b in banlist:
-        if (b['expire'] and (time.time() > b['expire_time'])):
-            count += 1
-            banlist.remove(b)
-            if (b['ip'] in banlistRaw):
-                banlistRaw.remove(b['ip'])
-    write_data('banList', banlist)
-    write_data('banListRaw', banlistRaw)
+    # 载入封禁列表，过期数据在载入时直接丢弃
+    count = banlist.load(read_data('banList') or [])
     if (count != 0):
+        banlist.dirty = True
+        save_banlist()
         logger.info(f'已移除{count}条过期封禁数据')
-
-    # 处理旧版数据库的banListRaw
-    banlist = read_data('banList')
-    banlistRaw = read_data('banListRaw')
-    if (banlist != [] and banlistRaw == []):
-        for b in banlist:
-            banlistRaw.append(b['ip'])
     return
 
 
+class BanList:
+    '''
+    以ip为键的封禁表，带过期时间的封禁同时放入小根堆，查询时惰性清理
+    '''
+    def __init__(self):
+        self.index = {}
+        self.heap = []
+        self.dirty = False
+
+    def _add(self, entry):
+        current = self.index.get(entry['ip'])
+        # 同一ip的多条封禁只保留生效时间最长的一条
+        if (current and ((not current['expire']) or (entry['expire'] and current['expire_time'] >= entry['expire_time']))):
+            return
+        self.index[entry['ip']] = entry
+        if (entry['expire']):
+            heapq.heappush(self.heap, (entry['expire_time'], entry['ip']))
+
+    def load(self, entries):
+        '''
+        从data.db中的banList载入，返回被丢弃的过期条目数量
+        '''
+        self.index = {}
+        self.heap = []
+        now = time.time()
+        count = 0
+        for b in entries:
+            if (b['expire'] and b['expire_time'] <= now):
+                count += 1
+                continue
+            self._add(b)
+        return count
+
+    def add(self, entry):
+        self._add(entry)
+        self.dirty = True
+
+    def prune(self, now = None):
+        now = time.time() if (now is None) else now
+        while (self.heap and self.heap[0][0] <= now):
+            expire_time, ip = heapq.heappop(self.heap)
+            entry = self.index.get(ip)
+            # 堆中可能残留被更长封禁覆盖的旧条目，需要与索引中的到期时间核对
+            if (entry and entry['expire'] and entry['expire_time'] <= now):
+                del self.index[ip]
+                self.dirty = True
+
+    def contains(self, ip_addr):
+        entry = self.index.get(ip_addr)
+        if (entry is None):
+            return False
+        if (entry['expire'] and entry['expire_time'] <= time.time()):
+            self.prune()
+            return False
+        return True
+
+    def merge(self, entries):
+        '''
+        合并其它进程写入的封禁，不会标记为需要保存
+        '''
+        now = time.time()
+        for b in entries or []:
+            if (not (b['expire'] and b['expire_time'] <= now)):
+                self._add(b)
+
+    def dump(self):
+        return list(self.index.values()), list(self.index.keys())
+
+
+banlist = BanList()
+
+
+def save_banlist():
+    if (not banlist.dirty):
+        return
+    banlist.dirty = False
+
+    def _merge(stored):
+        # 多进程模式下每个进程各自持有封禁表，写入时合并，同时载入其它进程的封禁
+        if (variable.worker_id is not None):
+            banlist.merge(stored)
+        return banlist.dump()[0]
+    entries = update_data('banList', _merge)
+    write_data('banListRaw', [b['ip'] for b in entries])
+
+
+async def persist_banlist():
+    if (variable.worker_id is not None):
+        # 即使本进程没有新的封禁，也需要定期载入其它进程的封禁
+        banlist.dirty = True
+    banlist.prune()
+    save_banlist()
+
+
 def ban_ip(ip_addr, ban_time=-1):
     if read_config('security.banlist.enable'):
-        banList = read_data('banList')
-        banList.append({
+        length = read_config('security.banlist.expire.length') if (ban_time == -1) else ban_time
+        banlist.add({
             'ip': ip_addr,
             'expire': read_config('security.banlist.expire.enable'),
-            'expire_time': read_config('security.banlist.expire.length') if (ban_time == -1) else ban_time,
+            'expire_time': int(time.time()) + length,
         })
-        write_data('banList', banList)
-        banListRaw = read_data('banListRaw')
-        if (ip_addr not in banListRaw):
-            banListRaw.append(ip_addr)
-            write_data('banListRaw', banListRaw)
     else:
         if (variable.banList_suggest < 10):
             variable.banList_suggest += 1
@@ -490,27 +1113,7 @@ def ban_ip(ip_addr, ban_time=-1):
 
 def check_ip_banned(ip_addr):
     if read_config('security.banlist.enable'):
-        banList = read_data('banList')
-        banlistRaw = read_data('banListRaw')
-        if (ip_addr in banlistRaw):
-            for b in banList:
-                if (b['ip'] == ip_addr):
-                    if (b['expire']):
-                        if (b['expire_time'] > int(time.time())):
-                            return True
-                        else:
-                            banList.remove(b)
-                            banlistRaw.remove(b['ip'])
-                            write_data('banListRaw', banlistRaw)
-                            write_data('banList', banList)
-                            return False
-                    else:
-                        return True
-                else:
-                    return False
-            return False
-        else:
-            return False
+        return banlist.contains(ip_addr)
     else:
         if (variable.banList_suggest <= 10):
             variable.banList_suggest += 1
@@ -519,3 +1122,9 @@ def check_ip_banned(ip_addr):
 
 
 initConfig()
+scheduler.append('banlist_persist', persist_banlist, 30, silent = True)
+scheduler.append('cache_stats_report', report_cache_stats, 3600)
+scheduler.append('cache_sweep', sweep_cache, 600, silent = True, leader_only = True)
+if (variable.worker_id is not None):
+    scheduler.append('config_reload', reload_config, 5, silent = True)
+    scheduler.append('cache_purge_sync', sync_cache_purges, 2, silent = True)
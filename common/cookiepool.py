@@ -0,0 +1,194 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: cookiepool.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# cookie池的账号选择，优先使用负载低、成功率高、响应快的账号，连续失败的账号会被暂停使用一段时间
+
+import time
+import random
+from . import config
+from . import metrics
+from . import variable
+from .exceptions import FailedException
+from .log import log
+
+logger = log('cookiepool')
+
+
+class AccountStats:
+    __slots__ = ('inflight', 'successes', 'failures', 'latency', 'success_rate',
+                 'consecutive_failures', 'quarantines', 'quarantined_until')
+
+    def __init__(self):
+        self.inflight = 0
+        self.successes = 0
+        self.failures = 0
+        # 耗时与成功率都使用指数移动平均，新账号按良好状态对待
+        self.latency = 0.5
+        self.success_rate = 1.0
+        self.consecutive_failures = 0
+        self.quarantines = 0
+        self.quarantined_until = 0
+
+    def score(self):
+        # 分数越低越优先：进行中的请求越多、越慢、成功率越低，分数越高
+        return (self.inflight + 1) * self.latency / max(self.success_rate, 0.05)
+
+
+class AccountPool:
+    '''
+    单个平台的cookie池
+    账号列表在配置被修改(如刷新登录)后会重新读取，账号数量不变时保留统计数据
+    '''
+    ALPHA = 0.2
+
+    def __init__(self, source):
+        self.source = source
+        self.users = None
+        self.stats = []
+
+    def _sync(self):
+        users = config.read_config(f'module.cookiepool.{self.source}') or []
+        if (users is not self.users):
+            if (len(users) != len(self.stats)):
+                self.stats = [AccountStats() for _ in users]
+            self.users = users
+        return users
+
+    def choose(self):
+        users = self._sync()
+        if (not users):
+            return None, None
+        now = time.time()
+        healthy = [i for i, s in enumerate(self.stats) if (s.quarantined_until <= now)]
+        if (not healthy):
+            # 所有账号都被暂停时，使用最早恢复的账号，而不是直接失败
+            index = min(range(len(self.stats)), key = lambda i: self.stats[i].quarantined_until)
+        else:
+            # 打乱顺序，使分数相同的账号被平均使用
+            random.shuffle(healthy)
+            index = min(healthy, key = lambda i: self.stats[i].score())
+        return index, users[index]
+
+    def enter(self, index):
+        if (index < len(self.stats)):
+            self.stats[index].inflight += 1
+
+    def release(self, index, failed, duration):
+        if ((index is None) or (index >= len(self.stats))):
+            return
+        s = self.stats[index]
+        s.inflight = max(0, s.inflight - 1)
+        if (failed is None):
+            return
+        s.latency += self.ALPHA * (duration - s.latency)
+        s.success_rate += self.ALPHA * ((0.0 if failed else 1.0) - s.success_rate)
+        if (not failed):
+            s.successes += 1
+            s.consecutive_failures = 0
+            s.quarantines = 0
+            return
+        s.failures += 1
+        s.consecutive_failures += 1
+        if (s.quarantined_until > time.time()):
+            # 暂停前已经发出的请求，失败不再延长暂停时间
+            return
+        if (s.consecutive_failures >= config.read_config('common.cookiepool_policy.failure_threshold')):
+            # 暂停时长随连续暂停次数翻倍，暂停结束后的第一次请求失败会再次暂停
+            length = min(config.read_config('common.cookiepool_policy.quarantine') * (2 ** s.quarantines),
+                         config.read_config('common.cookiepool_policy.max_quarantine'))
+            s.quarantines += 1
+            s.consecutive_failures = config.read_config('common.cookiepool_policy.failure_threshold') - 1
+            s.quarantined_until = time.time() + length
+            logger.warning(f'{self.source}的cookie池中第{index + 1}个账号连续请求失败，暂停使用{length}秒')
+
+
+class Lease:
+    '''
+    一次账号使用，with块正常结束计为成功，抛出Exception计为失败，被取消不计入
+    与账号无关的失败(如歌曲无版权)需要在抛出前调用neutral()
+    '''
+    def __init__(self, pool, index, user):
+        self.pool = pool
+        self.index = index
+        self.user = user
+        self._neutral = False
+        self._start = None
+
+    def neutral(self):
+        self._neutral = True
+
+    def __enter__(self):
+        # 在with块开始时才计入进行中的请求，acquire与with之间出错不会导致计数泄漏
+        if (self.pool is not None):
+            self.pool.enter(self.index)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if (self.pool is not None):
+            if (self._neutral or ((exc_type is not None) and (not issubclass(exc_type, Exception)))):
+                # 取消(请求合并、超时、对冲请求落后)等非Exception的中断与账号状态无关
+                failed = None
+            else:
+                failed = exc_type is not None
+            self.pool.release(self.index, failed, time.perf_counter() - self._start)
+        return False
+
+
+pools = {}
+
+
+def acquire(source):
+    '''
+    选择一个账号，未开启cookie池时使用module.<source>.user中的账号
+
+    @ return: Lease，账号数据在lease.user中
+    '''
+    if (not variable.use_cookie_pool):
+        return Lease(None, None, config.read_config(f'module.{source}.user'))
+    pool = pools.get(source)
+    if (pool is None):
+        pool = pools[source] = AccountPool(source)
+    index, user = pool.choose()
+    if (user is None):
+        raise FailedException(f'{source}的cookie池中没有配置账号')
+    return Lease(pool, index, user)
+
+
+def stats():
+    '''
+    各平台账号的使用情况，不包含账号数据本身
+    '''
+    now = time.time()
+    return {source: [{
+        'inflight': s.inflight,
+        'successes': s.successes,
+        'failures': s.failures,
+        'success_rate': round(s.success_rate, 3),
+        'latency': round(s.latency, 3),
+        'quarantined': max(0, int(s.quarantined_until - now)),
+    } for s in pool.stats] for source, pool in pools.items()}
+
+
+@metrics.register_collector
+def _collect_pools():
+    now = time.time()
+    samples = {'inflight': [], 'success': [], 'failure': [], 'quarantined': []}
+    for source, pool in list(pools.items()):
+        for i, s in enumerate(pool.stats):
+            labels = (source, str(i + 1))
+            samples['inflight'].append((labels, s.inflight))
+            samples['success'].append((labels, s.successes))
+            samples['failure'].append((labels, s.failures))
+            samples['quarantined'].append((labels, 1 if (s.quarantined_until > now) else 0))
+    labels = ('source', 'account')
+    return [('lx_cookiepool_inflight', 'gauge', 'In-flight requests per cookie pool account', labels, samples['inflight']),
+            ('lx_cookiepool_success_total', 'counter', 'Successful requests per cookie pool account', labels, samples['success']),
+            ('lx_cookiepool_failure_total', 'counter', 'Failed requests per cookie pool account', labels, samples['failure']),
+            ('lx_cookiepool_quarantined', 'gauge', 'Whether a cookie pool account is currently quarantined', labels, samples['quarantined'])]
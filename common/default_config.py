@@ -20,14 +20,69 @@ common:
     allow_proxy: true # 是否允许反代
     real_ip_header: X-Real-IP # 反代来源ip的来源头，不懂请保持默认
   debug_mode: false # 是否开启调试模式
+  use_uvloop: true # 已安装uvloop(pip install uvloop)时使用它作为事件循环，未安装时忽略
   log_length_limit: 500 # 单条日志长度限制
+  http_body_sample: 0 # 非调试模式下抽样记录上游响应内容的比例(0~1)，0为不记录，调试模式下始终全部记录
   fakeip: 1.0.1.114 # 服务器在海外时的IP伪装值
+  startup_probe: # 启动前的环境检查(如检查服务器是否在中国大陆)，在开始监听前并发进行
+    enable: true
+    timeout: 3 # 所有检查的总时长限制(秒)，超时的检查会被忽略
+    ttl: 86400 # 检查结果的有效期(秒)，有效期内重启时不再重新检查，0为每次启动都检查
   proxy: # 代理配置，HTTP与HTTPS协议需分开配置
     enable: false
     http_value: http://127.0.0.1:7890
     https_value: http://127.0.0.1:7890
   log_file: true # 是否存储日志文件
-  cookiepool: false # 是否开启cookie池，这将允许用户配置多个cookie并在请求时随机使用一个，启用后请在module.cookiepool中配置cookie，在user处配置的cookie会被忽略，cookiepool中格式统一为列表嵌套user处的cookie的字典
+  log_rotate: # 日志文件轮转设置
+    max_size: 10 # 单个日志文件的最大大小(MB)，超过后轮转，0为不限制
+    backup_count: 3 # 保留的旧日志文件数量，0为直接清空
+  cookiepool: false # 是否开启cookie池，这将允许用户配置多个cookie并在请求时优先使用负载低、状态好的一个，启用后请在module.cookiepool中配置cookie，在user处配置的cookie会被忽略，cookiepool中格式统一为列表嵌套user处的cookie的字典
+  cookiepool_policy: # cookie池的账号选择策略
+    failure_threshold: 3 # 账号连续失败多少次后暂停使用
+    quarantine: 60 # 首次暂停的时长(秒)，之后每次连续暂停翻倍
+    max_quarantine: 3600 # 最长暂停时长(秒)
+  batch_url: # 批量获取链接的接口 POST /batch/url
+    enable: true
+    max_items: 100 # 单次请求最多包含的歌曲数
+    timeout: 15 # 整个请求的最长处理时间(秒)，届时仍未完成的歌曲会返回超时
+    concurrency: 4 # 每个平台同时进行的请求数，所有批量请求共用
+    weight: 0.5 # 每首歌计入来源ip限速的请求次数，整个请求至少计为一次，全局限速只计一次
+  http_pool: # 上游请求的连接池配置
+    default: # 默认配置，也用于未在pools中列出的地址
+      limit: 100 # 最大连接数
+      limit_per_host: 0 # 每个地址的最大连接数，0为不限制
+      keepalive: 60 # 空闲连接的保留时间(秒)
+      dns_ttl: 600 # DNS解析结果的缓存时间(秒)
+    pools: # 按平台划分的连接池，hosts为该连接池负责的地址，带上实际请求使用的协议(如http://)以便预连接被复用，只填写域名时按https处理，其余项不填时使用default中的值
+      tx:
+        hosts: [https://u.y.qq.com, https://u6.y.qq.com]
+        limit_per_host: 32
+      kg:
+        hosts: [https://gateway.kugou.com, http://gateway.kugou.com, http://mobilecdnbj.kugou.com, https://lyrics.kugou.com, https://songsearch.kugou.com]
+        limit_per_host: 32
+      wy:
+        hosts: [https://interface.music.163.com]
+        limit_per_host: 32
+      kw:
+        hosts: [https://bd-api.kuwo.cn, https://nmobi.kuwo.cn]
+        limit_per_host: 32
+      mg:
+        hosts: [https://m.music.migu.cn, http://app.c.nf.migu.cn]
+        limit_per_host: 32
+    warmup: # 预先建立到pools中各地址的连接，避免启动后或空闲后的首个请求等待DNS解析与TLS握手，已停止服务的平台不预连接
+      enable: true
+      interval: 50 # 重新预连接的间隔(秒)，应小于keepalive，0为只在启动时预连接
+  http_retry: # 可重复发送的上游请求(idempotent)使用的超时、重试与对冲请求设置
+    timeout: 8 # 单次尝试的超时时间(秒)
+    retries: 1 # 出错或返回5xx时的重试次数
+    hedge_delay: 1 # 延迟样本不足时，发出对冲请求前的等待时间(秒)，样本足够后使用最近请求的p95耗时
+    hedge_min_delay: 0.05 # 对冲请求前的最短等待时间(秒)
+    budget_ratio: 0.1 # 每个正常请求积累的重试机会，即重试与对冲请求最多占正常请求的比例
+    budget_max: 10 # 每个地址最多积累的重试机会
+  metrics: # Prometheus格式的运行指标
+    enable: true
+    path: /metrics
+    allow_public: false # 是否允许非内网ip访问，关闭时公网请求会得到404
   allow_download_script: true # 是否允许直接从服务端下载脚本，开启后可以直接访问 /script?key=你的请求key 下载脚本
   download_config: # 源脚本的相关配置
     name: 修改为你的源脚本名称
@@ -51,6 +106,25 @@ common:
   local_music: # 服务器侧本地音乐相关配置，如果需要使用此功能请确保你的带宽足够
     audio_path: ./audio
     temp_path: ./temp
+  cache: # 缓存相关配置
+    memory: # 位于cache.db之前的进程内缓存，热门歌曲的链接可直接从内存返回
+      enable: true
+      max_entries: 10000 # 最大缓存条目数
+      max_size: 64 # 最大占用内存(MB)，按序列化后的大小估算
+    stale: # 链接与歌词缓存过期后的处理
+      enable: true
+      revalidate: 60 # 过期后多少秒内直接返回旧数据，同时在后台刷新
+      grace: # 过期后在缓存中继续保留的时间(秒)，上游出错时返回保留的旧数据，链接缓存不会超过链接实际的有效期
+        urls: 600
+        lyric: 86400
+      early_beta: 1 # 在过期前随机提前刷新的倾向，越大越早，0为关闭，可以避免热门歌曲同时过期
+    negative: # 缓存上游明确返回的失败结果(如没有版权)，有效期内相同的请求直接返回失败，extra.cache为true
+      enable: true
+      ttl: # 各类失败结果的缓存时间(秒)，未列出或为0的类别不缓存
+        no_copyright: 3600 # 歌曲没有版权
+        quality: 600 # 歌曲没有请求的音质
+      sources: {} # 按平台覆盖上面的缓存时间，如 kg: {no_copyright: 7200}
+      admin_path: /cache/negative # 只允许本机访问，DELETE请求清除失败结果的缓存，可以用source、songId、quality参数缩小范围，多进程模式下其它worker会在2秒内同步清除
 
 security:
   rate_limit:
@@ -169,6 +243,36 @@ module:
       headers:
         User-Agent: okhttp/3.10.0
 
+  circuit_breaker: # 按平台熔断上游请求，上游持续出错或超时时直接返回失败，避免请求堆积
+    enable: true
+    timeout: 15 # 单次获取链接/歌词/信息的最长等待时间(秒)
+    window: 60 # 统计错误率的时间窗口(秒)
+    min_requests: 10 # 时间窗口内的请求数达到此值后才会判断是否熔断
+    error_rate: 0.5 # 出错(包括超时与慢请求)的比例达到此值时熔断
+    slow_call: 10 # 耗时超过此值(秒)的请求视为慢请求
+    open_time: 30 # 熔断多少秒后开始试探上游是否恢复
+    half_open_probes: 3 # 试探时放行的请求数，全部成功后恢复，任意一次失败则重新熔断
+
+  refresh_ahead: # 在热门歌曲的链接缓存过期前提前从上游刷新，使热门歌曲始终命中缓存
+    enable: true
+    lead: 120 # 在缓存过期前多少秒内开始刷新
+    min_hits: 3 # 最近一段时间内至少被请求多少次才会提前刷新，访问次数每分钟减半
+    budget: 30 # 每个平台每分钟最多用于提前刷新的上游请求数，多进程模式下由各worker平分(每个worker至少1次)
+    max_keys: 10000 # 最多跟踪的歌曲数量
+
+  quality_fallback: # 请求的音质不可用时，直接在服务端降级到可用的音质，实际音质在extra.quality.result中返回
+    enable: false # 也可以在请求时添加?fallback=1单独开启
+    ladder: # 从高到低的音质顺序，只会降级到比请求的音质更低的音质
+      - master
+      - dolby
+      - flac24bit
+      - flac
+      - 320k
+      - 128k
+    use_info: true # 先根据歌曲信息中的file_info(kg/tx)筛选出可用的音质，避免逐个请求不存在的音质
+    info_ttl: 604800 # 歌曲可用音质的缓存时间(秒)
+    max_attempts: 3 # 最多请求上游的音质数量
+
   gcsp: # 歌词适配后端配置
     # 请注意只允许私用，不要给原作者带来麻烦，谢谢
     enable: false # 是否启用歌词适配后端
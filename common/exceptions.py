@@ -9,4 +9,7 @@
 
 class FailedException(Exception):
     # 此错误用于处理代理API请求失败的情况
-    pass
\ No newline at end of file
+    # reason为失败的类别(如no_copyright)，上游明确返回的失败才需要填写，用于缓存失败结果
+    def __init__(self, *args, reason = None):
+        super().__init__(*args)
+        self.reason = reason
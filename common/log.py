@@ -15,11 +15,15 @@ import re
 import io
 import traceback
 import time
+import queue
+import atexit
+import threading
 from pygments import highlight
 from pygments.lexers import PythonLexer
 from pygments.formatters import TerminalFormatter
 from .utils import filterFileName, setGlobal, require
-from .variable import debug_mode, log_length_limit, log_file, log_files
+from . import variable
+from .variable import debug_mode, log_file, log_files, worker_id
 from colorama import Fore, Style
 from colorama import init as clinit
 
@@ -201,8 +205,163 @@ class fileWriter(logging.Handler):
         self.formatter = f2
 
     def emit(self, record: logging.LogRecord):
+        # 由文件缓冲区决定何时落盘，不在每条记录后flush
         self.file.write(self.format(record) + '\n')
-        self.file.flush()
+
+
+class LogWriter:
+    '''
+    日志写入线程
+    调用方只把记录放入队列，时间格式化、错误高亮、控制台输出与文件写入都在这个线程中按批完成
+    '''
+    BATCH_SIZE = 512
+
+    def __init__(self, max_size = 0, backup_count = 0, shared = False):
+        self.queue = queue.SimpleQueue()
+        self.max_size = max_size
+        self.backup_count = backup_count
+        # 多个进程写入同一个日志文件时，文件可能已被其它进程轮转
+        self.shared = shared
+        self.files = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if ((self._thread is not None) and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target = self._run, name = 'log_writer', daemon = True)
+            self._thread.start()
+
+    def put(self, record):
+        if (self._thread is None):
+            # flush之后仍有日志时重新启动写入线程
+            self.start()
+        self.queue.put(record)
+
+    def _replaced(self, f, filename):
+        try:
+            return os.stat(filename).st_ino != os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open(self, filename):
+        f = self.files.get(filename)
+        if ((f is not None) and self.shared and self._replaced(f, filename)):
+            self.files.pop(filename)
+            f.close()
+            if (f in log_files):
+                log_files.remove(f)
+            f = None
+        if (f is None):
+            f = open(filename, 'a+', encoding='utf-8')
+            self.files[filename] = f
+            log_files.append(f)
+        return f
+
+    def _rotate(self, filename):
+        f = self.files.pop(filename)
+        f.close()
+        if (f in log_files):
+            log_files.remove(f)
+        if (self.backup_count > 0):
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f'{filename}.{i}'
+                if (os.path.exists(src)):
+                    os.replace(src, f'{filename}.{i + 1}')
+            os.replace(filename, f'{filename}.1')
+        else:
+            os.remove(filename)
+
+    def _write_files(self, lines):
+        for filename, content in lines.items():
+            try:
+                f = self._open(filename)
+                f.write(''.join(content))
+                f.flush()
+                if ((self.max_size > 0) and (f.tell() >= self.max_size)):
+                    self._rotate(filename)
+            except:
+                sys.stderr.write("日志模块出错，本次日志可能无法记录，请报告给开发者: \n" + traceback.format_exc())
+
+    def _emit_console(self, logger, created, level, message):
+        if (level >= logging.WARNING):
+            i = message.find('Traceback (most recent call last):')
+            if ((i != -1) and (not message[:i].strip() or message[i - 1] == '\n')):
+                message = message[:i].rstrip() + '\n' + highlight_error(message[i:])
+        record = logger._logger.makeRecord(logger.module_name, level, '(unknown file)', 0, message, None, None)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        logger._logger.handle(record)
+
+    def _handle(self, batch):
+        lines = {}
+        for item in batch:
+            if (item is None):
+                continue
+            logger, created, level, message, allow_hidden = item
+            try:
+                if (logger.filename):
+                    lines.setdefault(logger.filename, []).append('{time}|[{name}/{level}]{msg}\n'.format(
+                        time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)),
+                        name = logger.module_name, level = logging.getLevelName(level), msg = message))
+                limit = variable.log_length_limit
+                if (allow_hidden and len(message) > limit):
+                    message = message[:limit] + " ..."
+                self._emit_console(logger, created, level, message)
+            except:
+                sys.stderr.write("日志模块出错，本次日志可能无法记录，请报告给开发者: \n" + traceback.format_exc())
+        self._write_files(lines)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while (len(batch) < self.BATCH_SIZE):
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._handle(batch)
+            if (None in batch):
+                return
+
+    def flush(self, timeout = 5):
+        '''
+        写入队列中剩余的日志并停止线程，进程退出时调用
+        '''
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if ((thread is None) or (not thread.is_alive())):
+            return
+        self.queue.put(None)
+        thread.join(timeout)
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+# 轮转设置在配置文件载入后由config.apply_log_settings设置
+writer = LogWriter(shared = worker_id is not None)
+atexit.register(writer.flush)
+
+
+def flush():
+    writer.flush()
+
+
+# 已创建的日志记录器，配置文件中的调试模式生效时需要重新设置级别
+loggers = []
+
+
+def set_debug_mode(enabled):
+    '''
+    开启或关闭所有日志记录器的调试输出
+    - enabled: 是否输出DEBUG级别的日志
+    '''
+    for logger in loggers:
+        logger._apply_level(enabled)
+
 
 class log:
     # 主类
@@ -211,10 +370,9 @@ class log:
         self._logger = logging.getLogger(module_name)
         if not output_level.upper() in dir(logging):
             raise NameError('Unknown loglevel: '+output_level)
-        if not debug_mode:
-            self._logger.setLevel(getattr(logging, output_level.upper()))
-        else:
-            self._logger.setLevel(logging.DEBUG)
+        self.output_level = getattr(logging, output_level.upper())
+        self._apply_level(debug_mode)
+        loggers.append(self)
         formatter = colorlog.ColoredFormatter(
             '%(log_color)s%(asctime)s|[%(name)s/%(levelname)s]|%(message)s',
             datefmt='%Y-%m-%d %H:%M:%S',
@@ -225,76 +383,60 @@ class log:
                 'ERROR': 'red',
                 'CRITICAL': 'red,bg_white',
             })
+        self.filename = None
         if log_file:
             if filename:
                 filename = filterFileName(filename)
             else:
                 filename = './logs/' + module_name + '.log'
-            self.file = open(filename, 'a+', encoding='utf-8')
-            log_files.append(self.file)
+            self.filename = filename
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
         self.module_name = module_name
         self._logger.addHandler(console_handler)
-        debug_handler = logging.StreamHandler()
-        debug_handler.setFormatter(formatter)
 
-    def debug(self, message, allow_hidden=True):
-        if (log_file):
-            self.file.write('{time}|[{name}/DEBUG]{msg}'.format(time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), name = self.module_name, msg = message) + '\n')
+    def _apply_level(self, debug):
+        self._logger.setLevel(logging.DEBUG if (debug) else self.output_level)
 
-        if len(str(message)) > log_length_limit and allow_hidden:
-            message = str(message)[:log_length_limit] + " ..."
-        self._logger.debug(message)
+    def _log(self, level, message, allow_hidden = True):
+        if (not self._logger.isEnabledFor(level)):
+            return
+        writer.put((self, time.time(), level, str(message), allow_hidden))
 
-    def log(self, message, allow_hidden=True):
-        if (log_file):
-            self.file.write('{time}|[{name}/INFO]{msg}'.format(time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), name = self.module_name, msg = message) + '\n')
+    def is_debug(self):
+        return self._logger.isEnabledFor(logging.DEBUG)
 
-        if len(str(message)) > log_length_limit and allow_hidden:
-            message = str(message)[:log_length_limit] + " ..."
-        self._logger.info(message)
+    def debug(self, message, allow_hidden=True):
+        '''
+        - message: 日志内容，也可以是返回日志内容的函数，只有在调试模式下才会被调用
+        '''
+        if (not self._logger.isEnabledFor(logging.DEBUG)):
+            return
+        if (callable(message)):
+            message = message()
+        self._log(logging.DEBUG, message, allow_hidden)
 
-    def info(self, message, allow_hidden=True):
-        if (log_file):
-            self.file.write('{time}|[{name}/INFO]{msg}'.format(time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), name = self.module_name, msg = message) + '\n')
+    def log(self, message, allow_hidden=True):
+        self._log(logging.INFO, message, allow_hidden)
 
-        if len(str(message)) > log_length_limit and allow_hidden:
-            message = str(message)[:log_length_limit] + "..."
-        self._logger.info(message)
+    def info(self, message, allow_hidden=True):
+        self._log(logging.INFO, message, allow_hidden)
 
     def warning(self, message):
-        if (log_file):
-            self.file.write('{time}|[{name}/WARNING]{msg}'.format(time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), name = self.module_name, msg = message) + '\n')
-
-        if (message.strip().startswith('Traceback')):
-            self._logger.warning('\n' + highlight_error(message))
-        else:
-            self._logger.warning(message)
+        self._log(logging.WARNING, message, False)
 
     def error(self, message):
-        if (log_file):
-            self.file.write('{time}|[{name}/ERROR]{msg}'.format(time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), name = self.module_name, msg = message) + '\n')
-
-        if (message.startswith('Traceback')):
-            self._logger.error('\n' + highlight_error(message))
-        else:
-            self._logger.error(message)
+        self._log(logging.ERROR, message, False)
 
     def critical(self, message):
-        if (log_file):
-            self.file.write('{time}|[{name}/CRITICAL]{msg}'.format(time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), name = self.module_name, msg = message) + '\n')
-
-        if (message.startswith('Traceback')):
-            self._logger.critical('\n' + highlight_error(message))
-        else:
-            self._logger.critical(message)
+        self._log(logging.CRITICAL, message, False)
 
     def set_level(self, loglevel):
         loglevel_upper = loglevel.upper()
         if not loglevel_upper in dir(logging):
             raise NameError('Unknown loglevel: ' + loglevel)
-        self._logger.setLevel(getattr(logging, loglevel_upper))
+        self.output_level = getattr(logging, loglevel_upper)
+        self._logger.setLevel(self.output_level)
 
     def getLogger(self):
         return self._logger
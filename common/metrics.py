@@ -0,0 +1,127 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: metrics.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# 运行指标，以Prometheus文本格式输出
+# 指标只在事件循环中更新，不加锁，更新时只有几次字典操作
+
+import bisect
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra = ''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if (extra):
+        pairs.append(extra)
+    return ('{' + ','.join(pairs) + '}') if (pairs) else ''
+
+
+def _format_value(value):
+    if (value == float('inf')):
+        return '+Inf'
+    if (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, amount = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in list(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}')
+        return lines
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels = (), buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.bounds = tuple(sorted(buckets))
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        v = self.values.get(labels)
+        if (v is None):
+            v = self.values[labels] = _HistogramValue(len(self.bounds) + 1)
+        # 每个桶只记录落在自己区间内的次数，输出时再累加
+        v.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        v.sum += value
+        v.count += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, v in list(self.values.items()):
+            total = 0
+            for bound, n in zip(self.bounds + (float('inf'),), v.buckets):
+                total += n
+                le = 'le="' + _format_value(float(bound)) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, labels, le)} {total}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(v.sum)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {v.count}')
+        return lines
+
+
+def register_collector(func):
+    '''
+    注册一个在输出时才读取数据的指标
+    - func: 返回[(name, type, documentation, labels, [(label_values, value), ...]), ...]的函数
+    '''
+    collectors.append(func)
+    return func
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    for func in collectors:
+        for name, kind, documentation, labels, samples in func():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for label_values, value in samples:
+                lines.append(f'{name}{_format_labels(labels, label_values)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+request_total = Counter('lx_requests_total', 'API requests by method, source and status', ('method', 'source', 'status'))
+request_duration = Histogram('lx_request_duration_seconds', 'API request latency by method and source', ('method', 'source'))
+rejected_total = Counter('lx_rejected_requests_total', 'Requests rejected before reaching a handler', ('reason',))
+upstream_total = Counter('lx_upstream_requests_total', 'Upstream HTTP requests by host and status, status is "error" when the request raised', ('host', 'status'))
+upstream_retries = Counter('lx_upstream_retries_total', 'Upstream retries and hedged requests by host, and retries refused by the retry budget', ('host', 'kind'))
+upstream_duration = Histogram('lx_upstream_duration_seconds', 'Upstream HTTP request latency by host', ('host',))
+task_duration = Histogram('lx_scheduler_task_duration_seconds', 'Scheduler task run time', ('task',))
+task_failures = Counter('lx_scheduler_task_failures_total', 'Scheduler task runs that raised', ('task',))
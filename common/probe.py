@@ -0,0 +1,110 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: probe.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# 启动前的环境检查，所有检查并发进行且有总时长限制，结果存入data.db，有效期内重启时直接使用
+
+import time
+import asyncio
+from . import config
+from . import Httpx
+from . import variable
+from .log import log
+
+logger = log('probe')
+
+# name -> (检查函数, 应用结果的函数)
+probes = {}
+
+
+def register(name, apply):
+    '''
+    注册一项启动检查
+    - name: 检查名称，也是data.db中保存结果使用的键
+    - apply: 接收检查结果并生效的函数，使用保存的结果时同样会调用
+
+    被装饰的协程函数返回可以序列化为JSON的检查结果，出错时直接抛出
+    '''
+    def decorator(func):
+        probes[name] = (func, apply)
+        return func
+    return decorator
+
+
+def _apply(name, result):
+    try:
+        probes[name][1](result)
+    except:
+        logger.warning(f'启动检查{name}的结果无效，已忽略')
+
+
+def _save(results):
+    def _merge(old):
+        saved = old if (isinstance(old, dict)) else {}
+        saved.update(results)
+        return saved
+    config.update_data('probes', _merge)
+
+
+async def run():
+    '''
+    进行所有启动检查，在开始监听前调用
+    超出时间限制或出错的检查会被忽略，相关设置保持默认值，结果也不会保存
+    '''
+    settings = config.read_config('common.startup_probe')
+    if ((not settings.get('enable')) or (not probes)):
+        return
+    ttl = settings.get('ttl') or 0
+    now = int(time.time())
+    saved = config.load_data().get('probes') or {}
+    pending = {}
+    for name, (func, _) in probes.items():
+        entry = saved.get(name)
+        if (isinstance(entry, dict) and (entry.get('time', 0) + ttl > now)):
+            logger.debug(f'使用{int(now - entry["time"])}秒前保存的启动检查结果: {name}')
+            _apply(name, entry.get('result'))
+        else:
+            pending[name] = asyncio.ensure_future(func())
+    if (not pending):
+        return
+    done, not_done = await asyncio.wait(pending.values(), timeout = settings.get('timeout'))
+    for task in not_done:
+        task.cancel()
+    if (not_done):
+        await asyncio.gather(*not_done, return_exceptions = True)
+    results = {}
+    for name, task in pending.items():
+        if (task in not_done):
+            logger.warning(f'启动检查{name}超时，已忽略')
+        elif (task.exception() is not None):
+            logger.warning(f'启动检查{name}失败，已忽略: {task.exception()!r}')
+        else:
+            results[name] = {'result': task.result(), 'time': now}
+            _apply(name, task.result())
+    if (results):
+        try:
+            _save(results)
+        except:
+            logger.warning('保存启动检查结果失败，下次启动时将重新检查')
+
+
+def _apply_region(result):
+    variable.iscn = bool(result['iscn'])
+    if (not variable.iscn):
+        variable.fakeip = config.read_config('common.fakeip')
+        logger.info(f"您在非中国大陆服务器({result.get('country')})上启动了项目，已自动开启ip伪装")
+        logger.warning("此方式无法解决咪咕音乐的链接获取问题，您可以配置代理，服务器地址可在下方链接中找到\nhttps://hidemy.io/cn/proxy-list/?country=CN#list")
+
+
+@register('region', _apply_region)
+async def _probe_region():
+    req = await Httpx.AsyncRequest('https://mips.kugou.com/check/iscn?&format=json', {
+        'method': 'GET',
+    })
+    body = req.json()
+    return {'iscn': bool(body['flag']), 'country': body.get('country')}
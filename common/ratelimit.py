@@ -0,0 +1,154 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: ratelimit.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# 内存中的请求限速器，只在后台把请求时间写回data.db
+
+import time
+from . import config
+from . import scheduler
+from . import variable
+from .log import log
+
+logger = log('rate_limit')
+
+SHARD_COUNT = 16
+SWEEP_INTERVAL = 5
+PERSIST_INTERVAL = 30
+
+
+class RequestTimeTable:
+    '''
+    按key分片保存最近一次放行请求的时间
+    每次清理只扫描一个分片，避免ip很多时一次性遍历整张表
+    '''
+    def __init__(self, shard_count = SHARD_COUNT):
+        self.shards = [{} for _ in range(shard_count)]
+        self.dirty = False
+        self._sweep_index = 0
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key):
+        return self._shard(key).get(key, 0)
+
+    def update(self, key, t = None):
+        self._shard(key)[key] = time.time() if (t is None) else t
+        self.dirty = True
+
+    def reset(self, key):
+        self._shard(key).pop(key, None)
+        self.dirty = True
+
+    def sweep(self, idle):
+        # 最近一次请求早于限速间隔的条目与不存在等价，直接移除即可
+        shard = self.shards[self._sweep_index]
+        self._sweep_index = (self._sweep_index + 1) % len(self.shards)
+        deadline = time.time() - idle
+        expired = [k for k, t in shard.items() if (t <= deadline)]
+        for k in expired:
+            del shard[k]
+        if (expired):
+            self.dirty = True
+        return len(expired)
+
+    def load(self, data):
+        for k, t in data.items():
+            self._shard(k)[k] = t
+
+    def dump(self):
+        result = {}
+        for shard in self.shards:
+            result.update(shard)
+        return result
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards)
+
+
+table = RequestTimeTable()
+
+
+def getRequestTime(ip):
+    return table.get(ip)
+
+
+def updateRequestTime(ip):
+    table.update(ip)
+
+
+def resetRequestTime(ip):
+    table.reset(ip)
+
+
+def _idle_length():
+    return max(config.read_config('security.rate_limit.global') or 0,
+               config.read_config('security.rate_limit.ip') or 0)
+
+
+def check(ip):
+    '''
+    检查并记录一次请求
+    - ip: 请求来源ip
+
+    @ return: None表示放行，否则为触发的限速类型('global'或'ip')
+    '''
+    now = time.time()
+    if ((now - table.get('global')) < config.read_config('security.rate_limit.global')):
+        return 'global'
+    if ((now - table.get(ip)) < config.read_config('security.rate_limit.ip')):
+        return 'ip'
+    table.update('global', now)
+    table.update(ip, now)
+    return None
+
+
+def charge(ip, weight):
+    '''
+    在已经放行的请求之外再计入weight次请求，用于批量接口按规模计费
+    只计入来源ip，全局限速已在check中按一次请求计入，避免一个批量请求使其它客户端都被全局限速
+    - ip: 请求来源ip
+    - weight: 额外计入的请求次数
+    '''
+    length = config.read_config('security.rate_limit.ip')
+    if ((weight <= 0) or (not length)):
+        return
+    # 推后最近一次请求的时间，使之后的请求需要多等待weight个间隔
+    table.update(ip, max(table.get(ip), time.time()) + length * weight)
+
+
+def save():
+    if (not table.dirty):
+        return
+    table.dirty = False
+    dumped = table.dump()
+
+    def _merge(stored):
+        # 多进程模式下各进程分别限速，写入时与其它进程的记录合并，只保留仍在限速间隔内的条目
+        if ((variable.worker_id is None) or (not isinstance(stored, dict))):
+            return dumped
+        deadline = time.time() - _idle_length()
+        merged = {k: t for k, t in stored.items() if (t > deadline)}
+        for k, t in dumped.items():
+            merged[k] = max(merged.get(k, 0), t)
+        return merged
+    config.update_data('requestTime', _merge)
+
+
+async def sweep():
+    table.sweep(_idle_length())
+
+
+async def persist():
+    save()
+
+
+table.load(config.read_data('requestTime') or {})
+scheduler.append('rate_limit_sweep', sweep, SWEEP_INTERVAL, silent = True)
+scheduler.append('rate_limit_persist', persist, PERSIST_INTERVAL, silent = True)
@@ -0,0 +1,53 @@
+# ----------------------------------------
+# - mode: python -
+# - author: helloplhm-qwq -
+# - name: response.py -
+# - project: lx-music-api-server -
+# - license: MIT -
+# ----------------------------------------
+# This file is part of the "lx-music-api-server" project.
+
+# 响应的JSON编码，默认输出紧凑的JSON，请求带有?pretty或开启调试模式时缩进输出
+
+import contextvars
+import ujson as json
+from . import variable
+
+# 当前请求是否需要缩进输出，由main中的中间件在每个请求开始时设置
+pretty = contextvars.ContextVar('pretty_output', default = False)
+
+
+class Encoded(dict):
+    '''
+    创建时就完成序列化的响应，多次返回同一个对象时不需要重复编码
+    创建后不能再修改内容，需要修改时先复制为普通的dict
+    '''
+    __slots__ = ('body', )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.body = json.dumps(self, ensure_ascii = False, escape_forward_slashes = False).encode('utf-8')
+
+
+def want_pretty(query):
+    '''
+    根据请求参数判断是否需要缩进输出
+    - query: 请求的query参数
+    '''
+    if (variable.debug_mode):
+        return True
+    value = query.get('pretty')
+    return (value is not None) and (value.lower() not in ('0', 'false', 'no'))
+
+
+def dumps(dic):
+    '''
+    序列化响应
+
+    @ return: bytes
+    '''
+    if (pretty.get()):
+        return json.dumps(dic, indent = 2, ensure_ascii = False, escape_forward_slashes = False).encode('utf-8')
+    if (isinstance(dic, Encoded)):
+        return dic.body
+    return json.dumps(dic, ensure_ascii = False, escape_forward_slashes = False).encode('utf-8')
@@ -14,6 +14,8 @@ import asyncio
 import traceback
 from .utils import timestamp_format
 from . import log
+from . import metrics
+from . import variable
 
 logger = log.log("scheduler")
 running_event = asyncio.Event()
@@ -21,31 +23,38 @@ global tasks
 tasks = []
 
 class taskWrapper:
-    def __init__(self, name, function, interval = 86400, args = {}, latest_execute = 0):
+    def __init__(self, name, function, interval = 86400, args = {}, latest_execute = 0, silent = False, leader_only = False):
         self.function = function
         self.interval = interval
         self.name = name
         self.latest_execute = latest_execute
         self.args = args
+        # 高频的内部任务只在调试模式下输出运行日志
+        self.silent = silent
+        # 多进程模式下只在leader进程中运行
+        self.leader_only = leader_only
 
     def check_available(self):
         return (time.time() - self.latest_execute) >= self.interval
 
     async def run(self):
+        start_time = time.perf_counter()
         try:
-            logger.info(f"task {self.name} run start")
+            (logger.debug if self.silent else logger.info)(f"task {self.name} run start")
             await self.function(**self.args)
-            logger.info(f'task {self.name} run success, next execute: {timestamp_format(self.interval + self.latest_execute)}')
+            (logger.debug if self.silent else logger.info)(f'task {self.name} run success, next execute: {timestamp_format(self.interval + self.latest_execute)}')
         except Exception as e:
+            metrics.task_failures.inc(self.name)
             logger.error(f"task {self.name} run failed, waiting for next execute...")
             logger.error(traceback.format_exc())
+        metrics.task_duration.observe(time.perf_counter() - start_time, self.name)
 
     def __str__(self):
-        return f'SchedulerTaskWrapper(name="{self.name}", interval={self.interval}, function={self.function}, args={self.args}, latest_execute={self.latest_execute})'
+        return f'SchedulerTaskWrapper(name="{self.name}", interval={self.interval}, function={self.function}, args={self.args}, latest_execute={self.latest_execute}, silent={self.silent}, leader_only={self.leader_only})'
 
-def append(name, task, interval = 86400, args = {}):
+def append(name, task, interval = 86400, args = {}, silent = False, leader_only = False):
     global tasks
-    wrapper = taskWrapper(name, task, interval, args)
+    wrapper = taskWrapper(name, task, interval, args, silent = silent, leader_only = leader_only)
     logger.debug(f"new task ({name}) registered")
     return tasks.append(wrapper)
 
@@ -55,6 +64,8 @@ async def thread_runner():
     while not running_event.is_set():
         tasks_runner = []
         for t in tasks:
+            if (t.leader_only and not variable.is_leader):
+                continue
             if (t.check_available() and not running_event.is_set()):
                 t.latest_execute = int(time.time())
                 tasks_runner.append(t.run())
@@ -47,12 +47,19 @@ debug_mode = True if (_os.getenv('CURRENT_ENV') ==
                       'development') else (_dm if (_dm) else False)
 log_length_limit = _ll if (_ll) else 500
 log_file = _lm if (isinstance(_lm, bool)) else True
+# 多进程模式下由主进程通过环境变量传入的worker编号，单进程运行时为None
+_wid = _os.getenv('LX_WORKER_ID')
+worker_id = int(_wid) if (_wid and _wid.isdigit()) else None
+# 只在一个进程中运行的定时任务(如刷新登录)由leader执行，单进程运行时即为leader
+is_leader = (worker_id is None) or (worker_id == 0)
+_wc = _os.getenv('LX_WORKERS')
+worker_count = int(_wc) if (_wc and _wc.isdigit() and int(_wc) > 0) else 1
 running = True
 config = {}
 workdir = _os.getcwd()
 banList_suggest = 0
 iscn = True
-fake_ip = None
+fakeip = None
 aioSession = None
 qdes_lib_loaded = False
 use_cookie_pool = False
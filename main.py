@@ -10,17 +10,16 @@
 # This file is part of the "lx-music-api-server" project.
 
 import time
+import signal
+import socket
 import aiohttp
 import asyncio
 import traceback
-import threading
+import subprocess
 import ujson as json
 from aiohttp.web import Response, FileResponse, StreamResponse, Application
-from io import TextIOWrapper
 import sys
 import os
-import sqlite3
-import logging
 from aiohttp import web
 
 if sys.version_info < (3, 6):
@@ -33,12 +32,17 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from common import utils
 from common import config, localMusic
 from common import lxsecurity
+from common import ratelimit
+from common import auth
+from common import metrics
 from common import log
 from common import Httpx
 from common import variable
 from common import scheduler
 from common import lx_script
 from common import gcsp
+from common import response
+from common import probe
 import modules
 
 def handleResult(dic, status=200) -> Response:
@@ -48,7 +52,7 @@ def handleResult(dic, status=200) -> Response:
             'msg': 'success',
             'data': dic
         }
-    return Response(body=json.dumps(dic, indent=2, ensure_ascii=False), content_type='application/json', status=status)
+    return Response(body=response.dumps(dic), content_type='application/json', status=status)
 
 
 logger = log.log("main")
@@ -63,14 +67,31 @@ else:
     stopEvent = asyncio.exceptions.CancelledError
 
 
-def start_checkcn_thread() -> None:
-    threading.Thread(target=Httpx.checkcn).start()
-
 # check request info before start
 
 
+# 由modules中的同名函数处理的方法，其它方法交给modules.other转发到各平台
+MODULE_METHODS = ('url', 'lyric', 'search', 'info_with_query')
+
+# 只把已知的方法与平台作为指标标签，避免客户端构造的路径让标签数量无限增长
+METRIC_METHODS = ('url', 'lyric', 'info', 'search')
+
+
+def observe_request(request, status, start_time):
+    method = request.match_info.get('method')
+    source = request.match_info.get('source')
+    if ((method is None) or (source is None)):
+        return
+    method = method if (method in METRIC_METHODS) else 'other'
+    source = source if (source in modules.sourceExpirationTime) else 'other'
+    metrics.request_total.inc(method, source, str(status))
+    metrics.request_duration.observe(time.perf_counter() - start_time, method, source)
+
+
 async def handle_before_request(app, handler):
     async def handle_request(request):
+        start_time = time.perf_counter()
+        response.pretty.set(response.want_pretty(request.query))
         try:
             if config.read_config("common.reverse_proxy.allow_proxy") and request.headers.get(
                 config.read_config("common.reverse_proxy.real_ip_header")):
@@ -82,29 +103,23 @@ async def handle_before_request(app, handler):
                 request.remote_addr = request.remote
             # check ip
             if (config.check_ip_banned(request.remote_addr)):
+                metrics.rejected_total.inc('banned')
                 return handleResult({"code": 1, "msg": "您的IP已被封禁", "data": None}, 403)
-            # check global rate limit
-            if (
-                (time.time() - config.getRequestTime('global'))
-                <
-                (config.read_config("security.rate_limit.global"))
-            ):
+            # check rate limit (global first, then ip)
+            limited = ratelimit.check(request.remote_addr)
+            if (limited):
+                metrics.rejected_total.inc(f'rate_limit_{limited}')
+            if (limited == 'global'):
                 return handleResult({"code": 5, "msg": "全局限速", "data": None}, 429)
-            if (
-                (time.time() - config.getRequestTime(request.remote_addr))
-                <
-                (config.read_config("security.rate_limit.ip"))
-            ):
+            if (limited == 'ip'):
                 return handleResult({"code": 5, "msg": "IP限速", "data": None}, 429)
-            # update request time
-            config.updateRequestTime('global')
-            config.updateRequestTime(request.remote_addr)
             # check host
             if (config.read_config("security.allowed_host.enable")):
                 if request.host.split(":")[0] not in config.read_config("security.allowed_host.list"):
                     if config.read_config("security.allowed_host.blacklist.enable"):
                         config.ban_ip(request.remote_addr, int(
                             config.read_config("security.allowed_host.blacklist.length")))
+                    metrics.rejected_total.inc('host')
                     return handleResult({'code': 6, 'msg': '未找到您所请求的资源', 'data': None}, 404)
 
             resp = await handler(request)
@@ -120,6 +135,7 @@ async def handle_before_request(app, handler):
             elif (not isinstance(resp, (Response, FileResponse, StreamResponse))):
                 resp = Response(
                     body=str(resp), content_type='text/plain', status=200)
+            observe_request(request, resp.status, start_time)
             aiologger.info(
                 f'{request.remote_addr + ("" if (request.remote == request.remote_addr) else f"|proxy@{request.remote}")} - {request.method} "{request.path}", {resp.status}')
             return resp
@@ -133,60 +149,49 @@ async def main(request):
     return handleResult({"code": 0, "msg": "success", "data": None})
 
 
-# 配置日志
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s|[%(name)s/%(levelname)s]|%(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+def check_key(request):
+    '''
+    验证请求头中的用户名与key
 
-async def handle(request):
-    method = request.match_info.get('method')
-    source = request.match_info.get('source')
-    songId = request.match_info.get('songId')
-    quality = request.match_info.get('quality')
+    @ return: 验证通过或未开启验证时为None，否则为需要直接返回的响应
+    '''
+    if (not config.read_config("security.key.enable")):
+        return None
+    request_key = request.headers.get("X-Request-Key")
+    request_user = request.headers.get("X-Request-User")
 
-    # 从配置中读取验证相关设置
-    key_enable = config.read_config("security.key.enable")
-    whitelist_hosts = config.read_config('security.whitelist_host')
-    ban_enabled = config.read_config("security.key.ban")
+    # 记录接收到的用户名和 key
+    logger.info(f"收到验证请求 - 用户名: {request_user}, Key: {request_key}")
 
-    # 检查是否需要进行用户名和 key 验证
-    if key_enable:
-        request_key = request.headers.get("X-Request-Key")
-        request_user = request.headers.get("X-Request-User")
+    if not request_key or not request_user:
+        logger.warning("缺少用户名或 key")
+        return web.json_response({'code': 6, 'msg': '缺少用户名或 key', 'data': None}, status=403)
 
-        # 记录接收到的用户名和 key
-        logger.info(f"收到验证请求 - 用户名: {request_user}, Key: {request_key}")
+    # 验证用户名和 key，用户数据由 auth 模块缓存在内存中
+    result = auth.verify(request_user, request_key)
+    if (result is None):
+        logger.error("用户数据未能载入，请检查users.db")
+        return web.json_response({'code': 4, 'msg': '内部服务器错误', 'data': None}, status=500)
 
-        if not request_key or not request_user:
-            logger.warning("缺少用户名或 key")
-            return web.json_response({'code': 6, 'msg': '缺少用户名或 key', 'data': None}, status=403)
+    # 如果数据库中找不到用户，返回 403 错误
+    if not result:
+        logger.warning(f"用户验证失败 - 用户名: {request_user}, Key: {request_key} 不存在或不匹配")
+        return web.json_response({'code': 6, 'msg': 'key验证失败', 'data': None}, status=403)
 
-        # 连接到数据库并验证用户
-        try:
-            conn = sqlite3.connect('users.db')  # 确保数据库路径正确
-            cursor = conn.cursor()
-
-            # 查询数据库以验证用户名和 key
-            cursor.execute("SELECT name FROM users WHERE name = ? AND key = ?", (request_user, request_key))
-            result = cursor.fetchone()
-            conn.close()
-
-            logger.info(f"查询结果: {result}")  # 记录查询结果
-        except sqlite3.Error as e:
-            logger.error(f"数据库操作失败: {e}")
-            return web.json_response({'code': 4, 'msg': '内部服务器错误', 'data': None}, status=500)
+    # 用户验证成功的日志
+    logger.info(f"用户验证成功 - 用户名: {request_user}")
+    return None
 
-        # 如果数据库中找不到用户，返回 403 错误
-        if not result:
-            logger.warning(f"用户验证失败 - 用户名: {request_user}, Key: {request_key} 不存在或不匹配")
-            return web.json_response({'code': 6, 'msg': 'key验证失败', 'data': None}, status=403)
 
-        # 用户验证成功的日志
-        logger.info(f"用户验证成功 - 用户名: {request_user}")
+async def handle(request):
+    method = request.match_info.get('method')
+    source = request.match_info.get('source')
+    songId = request.match_info.get('songId')
+    quality = request.match_info.get('quality')
 
+    denied = check_key(request)
+    if (denied):
+        return denied
 
     if (config.read_config('security.check_lxm.enable') and request.host.split(':')[0] not in config.read_config('security.whitelist_host')):
         lxm = request.headers.get('lxm')
@@ -197,7 +202,7 @@ async def handle(request):
 
     try:
         query = dict(request.query)
-        if (method in dir(modules)):
+        if (method in MODULE_METHODS):
             source_enable = config.read_config(f'module.{source}.enable')
             if not source_enable:
                 return handleResult({
@@ -214,6 +219,136 @@ async def handle(request):
         return handleResult({'code': 4, 'msg': '内部服务器错误', 'data': None}, 500)
 
 
+# 每个平台同时进行的批量请求数，所有批量请求共用
+batch_semaphores = {}
+
+
+def _batch_semaphore(source):
+    sem = batch_semaphores.get(source)
+    if (sem is None):
+        sem = batch_semaphores[source] = asyncio.Semaphore(
+            max(1, int(config.read_config('common.batch_url.concurrency') or 1)))
+    return sem
+
+
+async def _resolve_batch_item(index, item):
+    source, songId, quality = item['source'], item['songId'], item['quality']
+    result = {'index': index, 'source': source, 'songId': songId, 'quality': quality}
+    if (not config.read_config(f'module.{source}.enable')):
+        result.update({'code': 4, 'msg': '此平台已停止服务', 'data': None})
+        return result
+    try:
+        async with _batch_semaphore(source):
+            result.update(await modules.url(source, songId, quality))
+    except:
+        logger.error(traceback.format_exc())
+        result.update({'code': 4, 'msg': '内部服务器错误', 'data': None})
+    return result
+
+
+def _parse_batch_items(body):
+    items = body.get('items') if isinstance(body, dict) else body
+    if (not isinstance(items, list)):
+        return None
+    parsed = []
+    for item in items:
+        if (not isinstance(item, dict)):
+            return None
+        source, songId, quality = item.get('source'), item.get('songId'), item.get('quality')
+        if (not (isinstance(source, str) and isinstance(songId, (str, int)) and isinstance(quality, str))):
+            return None
+        parsed.append({'source': source, 'songId': str(songId), 'quality': quality})
+    return parsed
+
+
+async def handle_batch_url(request):
+    '''
+    批量获取链接
+    请求体为[{"source": ..., "songId": ..., "quality": ...}, ...]或{"items": [...], "stream": bool}
+    结果按请求顺序返回，?stream=1时以NDJSON的形式在每首完成时立即输出
+    '''
+    denied = check_key(request)
+    if (denied):
+        return denied
+    try:
+        body = await request.json(loads=json.loads)
+    except:
+        return handleResult({'code': 6, 'msg': '请求参数有错', 'data': None}, 400)
+    items = _parse_batch_items(body)
+    if (items is None):
+        return handleResult({'code': 6, 'msg': '请求参数有错', 'data': None}, 400)
+    max_items = config.read_config('common.batch_url.max_items')
+    if (len(items) > max_items):
+        return handleResult({'code': 6, 'msg': f'单次请求最多包含{max_items}首歌曲', 'data': None}, 413)
+    # 进入接口时已经按一次请求计入限速，这里补上其余的部分
+    weight = max(1, int(len(items) * float(config.read_config('common.batch_url.weight') or 0) + 0.5))
+    ratelimit.charge(request.remote_addr, weight - 1)
+
+    stream = (request.query.get('stream') in ('1', 'true')) or (isinstance(body, dict) and body.get('stream') is True)
+    stream_response = None
+    if (stream):
+        stream_response = StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await stream_response.prepare(request)
+    results = [None] * len(items)
+
+    async def emit(result):
+        results[result['index']] = result
+        if (stream_response):
+            await stream_response.write(json.dumps(result, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + config.read_config('common.batch_url.timeout')
+    pending = {asyncio.ensure_future(_resolve_batch_item(i, item)) for i, item in enumerate(items)}
+    try:
+        while (pending):
+            timeout = deadline - loop.time()
+            if (timeout <= 0):
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                await emit(task.result())
+    finally:
+        for task in pending:
+            task.cancel()
+    for i, item in enumerate(items):
+        if (results[i] is None):
+            await emit({'index': i, **item, 'code': 2, 'msg': '处理超时', 'data': None})
+
+    if (stream_response):
+        await stream_response.write_eof()
+        return stream_response
+    return handleResult({'code': 0, 'msg': 'success', 'data': results})
+
+
+async def handle_metrics(request):
+    if ((not config.read_config('common.metrics.allow_public')) and (not utils.is_local_ip(request.remote_addr))):
+        return handleResult({'code': 6, 'msg': '未找到您所请求的资源', 'data': None}, 404)
+    return Response(body=metrics.render(), content_type='text/plain')
+
+
+async def handle_negative_cache(request):
+    '''
+    清除失败结果的缓存，source、songId、quality参数从左到右依次缩小范围，都不填时清除所有
+    '''
+    if (not utils.is_local_ip(request.remote_addr)):
+        return handleResult({'code': 6, 'msg': '未找到您所请求的资源', 'data': None}, 404)
+    source = request.query.get('source')
+    songId = request.query.get('songId')
+    quality = request.query.get('quality')
+    if (source == 'kg' and songId):
+        songId = songId.lower()
+    prefix = ''
+    if (source):
+        prefix = f'{source}_'
+        if (songId):
+            prefix += f'{songId}_'
+            if (quality):
+                prefix += quality
+    count = await config.purgeCacheAsync('urls_failed', prefix, exact = bool(source and songId and quality))
+    logger.info(f'已清除{count}条失败结果的缓存' + (f'，范围：{prefix}' if (prefix) else ''))
+    return handleResult({'code': 0, 'msg': 'success', 'data': {'deleted': count}})
+
+
 async def handle_404(request):
     return handleResult({'code': 6, 'msg': '未找到您所请求的资源', 'data': None}, 404)
 
@@ -279,6 +414,15 @@ if (config.read_config('common.allow_download_script')):
 if (config.read_config('module.gcsp.enable')):
     app.router.add_route('*', config.read_config('module.gcsp.path'), gcsp.handle_request)
 
+if (config.read_config('common.metrics.enable')):
+    app.router.add_get(config.read_config('common.metrics.path'), handle_metrics)
+
+if (config.read_config('common.batch_url.enable')):
+    app.router.add_post('/batch/url', handle_batch_url)
+
+if (config.read_config('common.cache.negative.enable')):
+    app.router.add_delete(config.read_config('common.cache.negative.admin_path'), handle_negative_cache)
+
 # 404
 app.router.add_route('*', '/{tail:.*}', handle_404)
 
@@ -302,6 +446,8 @@ async def run_app_host(host):
                 else:
                     if (p not in variable.running_ports):
                         final_ssl_ports.append(p)
+            # 多进程模式下所有worker监听相同的端口，由内核分配连接
+            reuse_port = True if (variable.worker_id is not None) else None
             # 读取证书和私钥路径
             cert_path = config.read_config('common.ssl_info.path.cert')
             privkey_path = config.read_config(
@@ -315,7 +461,7 @@ async def run_app_host(host):
             for port in final_ports:
                 if (port not in variable.running_ports):
                     http_site = aiohttp.web.TCPSite(
-                        http_runner, host, port)
+                        http_runner, host, port, reuse_port=reuse_port)
                     await http_site.start()
                     variable.running_ports.append(f'{host}_{port}')
                     logger.info(f"""监听 -> http://{
@@ -339,7 +485,7 @@ async def run_app_host(host):
                     for port in ssl_ports:
                         if (port not in variable.running_ports):
                             https_site = aiohttp.web.TCPSite(
-                                https_runner, host, port, ssl_context=ssl_context)
+                                https_runner, host, port, ssl_context=ssl_context, reuse_port=reuse_port)
                             await https_site.start()
                             variable.running_ports.append(f'{host}_{port}')
                             logger.info(f"""监听 -> https://{
@@ -364,13 +510,32 @@ async def run_app():
         await run_app_host(host)
 
 
+# 只在启动时预连接一次的任务
+warmup_task = None
+
+
 async def initMain():
+    global warmup_task
     await scheduler.run()
-    variable.aioSession = aiohttp.ClientSession(trust_env=True)
+    Httpx.load_pools()
+    if (config.read_config('common.http_pool.warmup.enable')):
+        interval = config.read_config('common.http_pool.warmup.interval')
+        if (interval):
+            # 调度器会立即执行一次，之后定期执行使空闲的连接保持可用
+            scheduler.append('http_warmup', Httpx.warmup, interval, silent = True)
+        else:
+            # 保留引用，避免任务在完成前被回收
+            warmup_task = asyncio.ensure_future(Httpx.warmup())
+    modules.initMain()
     localMusic.initMain()
     try:
+        # 环境检查完成后再开始监听，避免最初的请求使用错误的设置
+        await probe.run()
         await run_app()
-        logger.info("服务器启动成功，请按下Ctrl + C停止")
+        if (variable.worker_id is not None):
+            logger.info(f"worker {variable.worker_id} 启动成功" + ("(leader)" if (variable.is_leader) else ""))
+        else:
+            logger.info("服务器启动成功，请按下Ctrl + C停止")
         await asyncio.Event().wait()  # 等待停止事件
     except (KeyboardInterrupt, stopEvent):
         pass
@@ -382,16 +547,121 @@ async def initMain():
         logger.error(traceback.format_exc())
     finally:
         logger.info('wating for sessions to complete...')
-        if variable.aioSession:
-            await variable.aioSession.close()
+        await Httpx.close_sessions()
+        ratelimit.save()
+        config.save_banlist()
+        await config.flushCache()
 
         variable.running = False
         logger.info("Server stopped")
 
+def install_uvloop():
+    '''
+    已安装uvloop且配置允许时使用它作为事件循环
+    '''
+    if (not config.read_config('common.use_uvloop')):
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.debug('未安装uvloop，使用默认的事件循环')
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info('已使用uvloop作为事件循环')
+
+
+def parse_workers(argv):
+    '''
+    读取命令行参数中的--workers N，未指定时为1
+    '''
+    for i, arg in enumerate(argv):
+        if (arg == '--workers' and i + 1 < len(argv)):
+            value = argv[i + 1]
+        elif (arg.startswith('--workers=')):
+            value = arg.split('=', 1)[1]
+        else:
+            continue
+        try:
+            return max(1, int(value))
+        except ValueError:
+            logger.warning(f'--workers参数无效：{value}，将以单进程运行')
+            return 1
+    return 1
+
+
+def run_supervisor(count):
+    '''
+    多进程模式的主进程，只负责启动worker并在worker退出后重新启动
+    worker是重新执行的本脚本而不是fork出的子进程，避免继承日志线程、线程池与数据库连接
+    '''
+    workers = {}
+    restart_at = {}
+    failures = [0] * count
+    stopping = False
+
+    def spawn(i):
+        env = dict(os.environ, LX_WORKER_ID=str(i), LX_WORKERS=str(count))
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        workers[i] = (proc, time.time())
+        logger.info(f'worker {i} 已启动，pid: {proc.pid}')
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    logger.info(f'以多进程模式运行，共{count}个worker')
+    for i in range(count):
+        spawn(i)
+    try:
+        while (not stopping):
+            time.sleep(0.5)
+            now = time.time()
+            for i, (proc, started) in list(workers.items()):
+                if (proc.poll() is None):
+                    continue
+                if (i not in restart_at):
+                    # 启动后很快就退出的worker逐次延长重启间隔，避免配置有误时不停重启
+                    failures[i] = (failures[i] + 1) if (now - started < 10) else 0
+                    delay = min(2 ** failures[i], 30) if (failures[i]) else 0
+                    logger.warning(f'worker {i} (pid: {proc.pid}) 已退出，返回值：{proc.returncode}，{delay}秒后重新启动')
+                    restart_at[i] = now + delay
+                if (now >= restart_at[i]):
+                    restart_at.pop(i)
+                    spawn(i)
+    except KeyboardInterrupt:
+        pass
+    logger.info('正在停止所有worker...')
+    for proc, _ in workers.values():
+        if (proc.poll() is None):
+            proc.terminate()
+    deadline = time.time() + 15
+    for proc, _ in workers.values():
+        while True:
+            try:
+                proc.wait(max(0, deadline - time.time()))
+                break
+            except subprocess.TimeoutExpired:
+                logger.warning(f'worker (pid: {proc.pid}) 未能按时退出，已强制结束')
+                proc.kill()
+            except KeyboardInterrupt:
+                continue
+
+
 if __name__ == "__main__":
     try:
-        start_checkcn_thread()
-        asyncio.run(initMain())
+        workers = parse_workers(sys.argv[1:])
+        if ((workers > 1) and (variable.worker_id is None) and hasattr(socket, 'SO_REUSEPORT')):
+            run_supervisor(workers)
+        else:
+            if ((workers > 1) and (variable.worker_id is None)):
+                logger.warning('当前系统不支持SO_REUSEPORT，无法使用多进程模式，将以单进程运行')
+            if (variable.worker_id is not None):
+                # worker只响应主进程发送的SIGTERM，终端中的Ctrl + C由主进程统一处理
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+            install_uvloop()
+            asyncio.run(initMain())
     except KeyboardInterrupt:
         pass
     except:
@@ -409,6 +679,4 @@ if __name__ == "__main__":
             f.write(e)
         logger.critical('dumprecord_{}.txt 已保存至当前目录'.format(int(time.time())))
     finally:
-        for f in variable.log_files:
-            if (f and isinstance(f, TextIOWrapper)):
-                f.close()
+        log.flush()
@@ -8,16 +8,19 @@
 # This file is part of the "lx-music-api-server" project.
 
 from common.exceptions import FailedException
-from common.utils import require
 from common import log
 from common import config
-# 从.引入的包并没有在代码中直接使用，但是是用require在请求时进行引入的，不要动
-from . import kw
-from . import mg
-from . import kg
-from . import tx
-from . import wy
+from common import metrics
+from common import scheduler
+from common import breaker
+from common import response
+from common import variable
+import importlib
+import collections
 import traceback
+import asyncio
+import random
+import math
 import time
 
 logger = log.log('api_handler')
@@ -46,8 +49,293 @@ sourceExpirationTime = {
 
 }
 
+# 各平台的包只在启用时或第一次使用时引入，未启用的平台不会加载加密库、注册定时任务
+_sources = ('kw', 'mg', 'kg', 'tx', 'wy')
+_loaded = {}
 
-async def url(source, songId, quality, query = {}):
+
+def _load(source):
+    '''
+    引入平台的包，第一次引入时调用包中的init注册定时任务
+    - source: 平台名
+
+    @ return: 平台的包，未知的平台返回None
+    '''
+    module = _loaded.get(source)
+    if ((module is None) and (source in _sources)):
+        module = _loaded[source] = importlib.import_module('.' + source, __name__)
+        init = getattr(module, 'init', None)
+        if (init is not None):
+            try:
+                init()
+            except:
+                logger.error(f'初始化平台{source}失败\n' + traceback.format_exc())
+    return module
+
+
+def _require(source, name):
+    module = _load(source)
+    if (module is None):
+        raise AttributeError('未知的源: ' + str(source))
+    return getattr(module, name)
+
+
+def initMain():
+    '''
+    引入所有已启用的平台，在开始监听前调用
+    '''
+    for source in _sources:
+        if (config.read_config(f'module.{source}.enable')):
+            _load(source)
+            logger.debug(f'已加载平台: {source}')
+
+
+# 歌曲信息的file_info中会列出的音质，其它音质无法通过歌曲信息判断是否可用
+infoQualities = {
+    'kg': ('128k', '320k', 'flac', 'flac24bit'),
+    'tx': ('128k', '320k', 'flac', 'flac24bit', 'dolby', 'master'),
+}
+
+
+class _InFlight:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+# 进行中的上游请求，key与缓存的key保持一致
+inflight = {}
+# 各类请求的计数：hit为命中缓存，upstream为实际发起的上游请求，coalesced为合并到进行中请求的次数，negative为命中失败结果的缓存
+inflight_stats = {}
+
+
+def _stats(namespace):
+    stats = inflight_stats.get(namespace)
+    if (stats is None):
+        stats = inflight_stats[namespace] = {'hit': 0, 'upstream': 0, 'coalesced': 0, 'negative': 0}
+    return stats
+
+
+@metrics.register_collector
+def _collect_inflight_stats():
+    samples = []
+    for namespace, stats in list(inflight_stats.items()):
+        for kind, value in stats.items():
+            samples.append(((namespace, kind), value))
+    return [('lx_lookups_total', 'counter', 'url/lyric/other lookups by namespace and result (hit, upstream, coalesced or negative)', ('namespace', 'result'), samples),
+            ('lx_inflight_requests', 'gauge', 'Upstream lookups currently in flight', (), [((), len(inflight))]),
+            ('lx_refresh_ahead_total', 'counter', 'Refresh-ahead attempts by result', ('result',), [((k,), v) for k, v in refresh_stats.items()]),
+            ('lx_refresh_ahead_tracked_keys', 'gauge', 'URL cache keys tracked for refresh-ahead', (), [((), len(hot_keys))])]
+
+
+async def coalesce(namespace, key, factory):
+    '''
+    合并相同key的并发请求，所有调用方等待同一个上游任务的结果或异常
+    - namespace: 缓存命名空间，如urls/lyric
+    - key: 缓存key
+    - factory: 无参数的协程函数，只会由第一个调用方执行
+    '''
+    full_key = f'{namespace}_{key}'
+    flight = inflight.get(full_key)
+    if (flight is None):
+        flight = _InFlight(asyncio.create_task(factory()))
+        inflight[full_key] = flight
+
+        def _done(_):
+            if (inflight.get(full_key) is flight):
+                inflight.pop(full_key)
+        flight.task.add_done_callback(_done)
+        _stats(namespace)['upstream'] += 1
+    else:
+        _stats(namespace)['coalesced'] += 1
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        # 所有等待方都已被取消时，上游请求也没有继续的必要
+        if (flight.waiters == 0 and not flight.task.done()):
+            if (inflight.get(full_key) is flight):
+                inflight.pop(full_key)
+            flight.task.cancel()
+
+
+def _negative_ttl(source, reason):
+    # 失败结果的缓存时间，平台单独的设置优先
+    if ((not reason) or (not config.read_config('common.cache.negative.enable'))):
+        return 0
+    overrides = (config.read_config('common.cache.negative.sources') or {}).get(source) or {}
+    if (reason in overrides):
+        return int(overrides[reason] or 0)
+    return int((config.read_config('common.cache.negative.ttl') or {}).get(reason) or 0)
+
+
+async def _fetch_url(func, source, songId, quality):
+    start_time = time.perf_counter()
+    try:
+        result = await breaker.call(source, lambda: func(songId, quality))
+    except FailedException as e:
+        ttl = _negative_ttl(source, e.reason)
+        if (ttl > 0):
+            await config.updateCacheAsync('urls_failed', f'{source}_{songId}_{quality}', {
+                "msg": e.args[0] if e.args else 'failed',
+                "reason": e.reason,
+                "time": int(time.time()) + ttl,
+                "expire": True,
+            }, grace = 0)
+        raise
+    logger.info(f'获取{source}_{songId}_{quality}成功，URL：{result["url"]}')
+
+    canExpire = sourceExpirationTime[source]['expire']
+    expireTime = sourceExpirationTime[source]['time'] + int(time.time())
+    await config.updateCacheAsync('urls', f'{source}_{songId}_{quality}', {
+        "expire": canExpire,
+        # 取有效期的75%作为链接可用时长
+        "time": int(expireTime - sourceExpirationTime[source]['time'] * 0.25),
+        "url": result['url'],
+        # 获取耗时，用于计算提前过期的概率
+        "delta": round(time.perf_counter() - start_time, 3),
+        }, grace = min(config.stale_grace('urls'), int(sourceExpirationTime[source]['time'] * 0.25))) # 过期后保留的时间不超过链接实际的有效期
+    logger.debug(f'缓存已更新：{source}_{songId}_{quality}, URL：{result["url"]}, expire: {expireTime}')
+    return result, expireTime
+
+
+class _HotKey:
+    __slots__ = ('source', 'songId', 'quality', 'hits', 'expires_at', 'retry_at')
+
+    def __init__(self, source, songId, quality):
+        self.source = source
+        self.songId = songId
+        self.quality = quality
+        self.hits = 0
+        self.expires_at = None
+        self.retry_at = 0
+
+
+# 被请求过的链接缓存，key与缓存的key一致，用于在热门歌曲的缓存过期前提前刷新
+hot_keys = {}
+# 每个平台当前一分钟内已用于提前刷新的上游请求数，source -> [minute, count]
+refresh_budget = {}
+refresh_stats = {'refreshed': 0, 'failed': 0, 'over_budget': 0}
+_refresh_tasks = set()
+_last_decay = time.time()
+
+
+def _track_url(source, songId, quality, cache_time, canExpire):
+    # cache_time为缓存中记录的可用时间，也就是提前刷新的截止时间
+    if ((not canExpire) or (not config.read_config('module.refresh_ahead.enable'))):
+        return
+    key = f'{source}_{songId}_{quality}'
+    entry = hot_keys.get(key)
+    if (entry is None):
+        if (len(hot_keys) >= config.read_config('module.refresh_ahead.max_keys')):
+            return
+        entry = hot_keys[key] = _HotKey(source, songId, quality)
+    entry.hits += 1
+    entry.expires_at = cache_time
+
+
+def _take_budget(source):
+    minute = int(time.time() // 60)
+    used = refresh_budget.get(source)
+    if ((used is None) or (used[0] != minute)):
+        used = refresh_budget[source] = [minute, 0]
+    # 多进程模式下每个worker分别统计热门歌曲，预算按worker数平分，每个worker至少1次
+    budget = max(1, config.read_config('module.refresh_ahead.budget') // variable.worker_count)
+    if (used[1] >= budget):
+        return False
+    used[1] += 1
+    return True
+
+
+def _spawn(coro):
+    # 后台刷新不阻塞当前请求，保留引用避免任务被回收
+    task = asyncio.ensure_future(coro)
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+def _cache_state(cache):
+    '''
+    判断缓存是否需要刷新
+
+    @ return: fresh为可直接使用，revalidate为返回缓存并在后台刷新，stale为已过期，只在上游出错时使用
+    '''
+    if ((not cache['expire']) or (not config.read_config('common.cache.stale.enable'))):
+        return 'fresh'
+    now = time.time()
+    if (now >= cache['time']):
+        if (now < cache['time'] + config.read_config('common.cache.stale.revalidate')):
+            return 'revalidate'
+        return 'stale'
+    # 按获取耗时随机提前过期，越接近过期时间越容易被选中，避免热门缓存同时过期
+    beta = config.read_config('common.cache.stale.early_beta')
+    if (beta and now - cache.get('delta', 1) * beta * math.log(1 - random.random()) >= cache['time']):
+        return 'revalidate'
+    return 'fresh'
+
+
+async def _refresh_url(source, songId, quality):
+    func = _require(source, 'url')
+    await coalesce('urls', f'{source}_{songId}_{quality}', lambda: _fetch_url(func, source, songId, quality))
+
+
+async def _revalidate(namespace, key, refresh):
+    if (f'{namespace}_{key}' in inflight):
+        return
+    try:
+        await refresh()
+        logger.debug(f'已在后台刷新{namespace}缓存：{key}')
+    except Exception as e:
+        logger.debug(f'后台刷新{namespace}缓存{key}失败: {e}')
+
+
+async def _refresh_ahead_url(key, entry):
+    try:
+        await _refresh_url(entry.source, entry.songId, entry.quality)
+        refresh_stats['refreshed'] += 1
+        logger.debug(f'已提前刷新{key}的链接缓存')
+    except Exception as e:
+        refresh_stats['failed'] += 1
+        # 失败后等待一段时间再试，缓存到期后由正常请求重新获取
+        entry.retry_at = time.time() + 60
+        logger.debug(f'提前刷新{key}的链接缓存失败: {e}')
+
+
+async def _refresh_ahead():
+    global _last_decay
+    if (not config.read_config('module.refresh_ahead.enable')):
+        hot_keys.clear()
+        return
+    now = time.time()
+    # 每分钟把访问次数减半，只有持续被请求的key才会保持热门
+    if (now - _last_decay >= 60):
+        _last_decay = now
+        for key in [k for k, e in hot_keys.items() if ((e.hits // 2) == 0 and (e.expires_at is None or e.expires_at <= now))]:
+            hot_keys.pop(key)
+        for entry in hot_keys.values():
+            entry.hits //= 2
+    lead = config.read_config('module.refresh_ahead.lead')
+    min_hits = config.read_config('module.refresh_ahead.min_hits')
+    for key, entry in list(hot_keys.items()):
+        if ((entry.expires_at is None) or (entry.hits < min_hits) or (entry.retry_at > now)):
+            continue
+        if (not (now < entry.expires_at <= now + lead)):
+            continue
+        if (f'urls_{key}' in inflight):
+            continue
+        if (not _take_budget(entry.source)):
+            refresh_stats['over_budget'] += 1
+            continue
+        # 刷新成功后会通过_fetch_url写入新的缓存，这里先清空，避免在完成前被重复选中
+        entry.expires_at = None
+        # 不等待刷新完成，避免阻塞调度器中的其它任务
+        _spawn(_refresh_ahead_url(key, entry))
+
+
+async def _url(source, songId, quality):
     if (not quality):
         return {
             'code': 2,
@@ -58,31 +346,37 @@ async def url(source, songId, quality, query = {}):
     if (source == "kg"):
         songId = songId.lower()
     
+    # 已过期的缓存，只在上游出错时返回
+    stale = None
     try:
-        cache = config.getCache('urls', f'{source}_{songId}_{quality}')
+        cache = await config.getCacheAsync('urls', f'{source}_{songId}_{quality}', allow_stale = True)
         if cache:
-            logger.debug(f'使用缓存的{source}_{songId}_{quality}数据，URL：{cache["url"]}')
-            return {
-                'code': 0,
-                'msg': 'success',
-                'data': cache['url'],
-                'extra': {
-                    'cache': True,
-                    'quality': {
-                        'target': quality,
-                        'result': quality,
+            state = _cache_state(cache)
+            if (state != 'stale'):
+                _stats('urls')['hit'] += 1
+                _track_url(source, songId, quality, cache['time'], cache['expire'])
+                if (state == 'revalidate'):
+                    _spawn(_revalidate('urls', f'{source}_{songId}_{quality}', lambda: _refresh_url(source, songId, quality)))
+                logger.debug(f'使用缓存的{source}_{songId}_{quality}数据，URL：{cache["url"]}')
+                return _cached_url(source, quality, cache)
+            stale = cache
+        if ((not stale) and config.read_config('common.cache.negative.enable')):
+            failed = await config.getCacheAsync('urls_failed', f'{source}_{songId}_{quality}')
+            if (failed):
+                _stats('urls')['negative'] += 1
+                return {
+                    'code': 2,
+                    'msg': failed['msg'],
+                    'data': None,
+                    'extra': {
+                        'cache': True,
+                        'reason': failed['reason'],
                     },
-                    'expire': {
-                        # 在更新缓存的时候把有效期的75%作为链接可用时长，现在加回来
-                        'time': int(cache['time'] + (sourceExpirationTime[source]['time'] * 0.25)) if cache['expire'] else None,
-                        'canExpire': cache['expire'],
-                    }
-                },
-            }
+                }
     except:
         logger.error(traceback.format_exc())
     try:
-        func = require('modules.' + source + '.url')
+        func = _require(source, 'url')
     except:
         return {
             'code': 1,
@@ -90,18 +384,10 @@ async def url(source, songId, quality, query = {}):
             'data': None,
         }
     try:
-        result = await func(songId, quality)
-        logger.info(f'获取{source}_{songId}_{quality}成功，URL：{result["url"]}')
-
+        result, expireTime = await coalesce('urls', f'{source}_{songId}_{quality}',
+                                            lambda: _fetch_url(func, source, songId, quality))
         canExpire = sourceExpirationTime[source]['expire']
-        expireTime = sourceExpirationTime[source]['time'] + int(time.time())
-        config.updateCache('urls', f'{source}_{songId}_{quality}', {
-            "expire": canExpire,
-            # 取有效期的75%作为链接可用时长
-            "time": int(expireTime - sourceExpirationTime[source]['time'] * 0.25),
-            "url": result['url'],
-            })
-        logger.debug(f'缓存已更新：{source}_{songId}_{quality}, URL：{result["url"]}, expire: {expireTime}')
+        _track_url(source, songId, quality, int(expireTime - sourceExpirationTime[source]['time'] * 0.25), canExpire)
 
         return {
             'code': 0,
@@ -119,7 +405,12 @@ async def url(source, songId, quality, query = {}):
                 },
             },
         }
-    except FailedException as e:
+    except Exception as e:
+        if (stale):
+            logger.info(f'获取{source}_{songId}_{quality}失败，返回已过期的缓存，原因：{e}')
+            return _cached_url(source, quality, stale)
+        if (not isinstance(e, FailedException)):
+            raise
         logger.info(f'获取{source}_{songId}_{quality}失败，原因：' + e.args[0])
         return {
             'code': 2,
@@ -127,16 +418,152 @@ async def url(source, songId, quality, query = {}):
             'data': None,
         }
 
+def _fallback_enabled(query):
+    value = query.get('fallback')
+    if (value is not None):
+        return value.lower() in ('1', 'true', 'yes')
+    return config.read_config('module.quality_fallback.enable')
+
+
+async def _available_qualities(source, songId):
+    '''
+    从歌曲信息中获取可用的音质，结果按歌曲缓存
+
+    @ return: 音质列表，无法获取时为None
+    '''
+    if (source not in infoQualities):
+        return None
+    cache = await config.getCacheAsync('quality', f'{source}_{songId}')
+    if (cache):
+        return cache['data']
+    try:
+        func = _require(source, 'info')
+        info = await coalesce('info', f'{source}_{songId}', lambda: breaker.call(source, lambda: func(songId)))
+    except Exception as e:
+        logger.debug(f'获取{source}_{songId}的可用音质失败: {e}')
+        return None
+    if ((not isinstance(info, dict)) or (not isinstance(info.get('file_info'), dict))):
+        return None
+    qualities = list(info['file_info'].keys())
+    await config.updateCacheAsync('quality', f'{source}_{songId}', {
+        "data": qualities,
+        "time": int(time.time()) + config.read_config('module.quality_fallback.info_ttl'),
+        "expire": True,
+    })
+    return qualities
+
+
+async def url(source, songId, quality, query = {}):
+    '''
+    获取歌曲链接，开启音质降级时按module.quality_fallback.ladder依次尝试更低的音质
+    extra.quality.target为请求的音质，extra.quality.result为实际返回的音质
+    '''
+    if ((not quality) or (not _fallback_enabled(query))):
+        return await _url(source, songId, quality)
+    ladder = config.read_config('module.quality_fallback.ladder') or []
+    if (quality not in ladder):
+        return await _url(source, songId, quality)
+    if (source == "kg"):
+        songId = songId.lower()
+    candidates = ladder[ladder.index(quality):]
+    if (config.read_config('module.quality_fallback.use_info')):
+        available = await _available_qualities(source, songId)
+        if (available is not None):
+            candidates = [q for q in candidates if ((q in available) or (q not in infoQualities[source]))]
+            if (not candidates):
+                return {
+                    'code': 2,
+                    'msg': '该歌曲没有可用的音质',
+                    'data': None,
+                }
+    result = None
+    for q in candidates[:max(1, config.read_config('module.quality_fallback.max_attempts'))]:
+        result = await _url(source, songId, q)
+        if (result['code'] == 0):
+            if (q != quality):
+                logger.info(f'{source}_{songId}的{quality}音质不可用，已降级为{q}')
+                # 缓存命中时的响应是共用的，不能直接修改
+                result = dict(result, extra = dict(result['extra'], quality = dict(result['extra']['quality'], target = quality)))
+            return result
+        # 未知的源或上游已熔断时，换音质也不会成功
+        if ((result['code'] != 2) or (breaker.get(source).state == breaker.OPEN)):
+            break
+    return result
+
+# 命中链接缓存时返回的响应，创建时就已经序列化，key包含了决定响应内容的所有字段
+_encoded_urls = collections.OrderedDict()
+ENCODED_URL_LIMIT = 4096
+
+
+def _cached_url(source, quality, cache):
+    stale = config.is_cache_stale(cache)
+    key = (source, quality, cache['url'], cache['time'], cache['expire'], stale)
+    result = _encoded_urls.get(key)
+    if (result is not None):
+        _encoded_urls.move_to_end(key)
+        return result
+    result = _encoded_urls[key] = response.Encoded(_build_cached_url(source, quality, cache, stale))
+    if (len(_encoded_urls) > ENCODED_URL_LIMIT):
+        _encoded_urls.popitem(last = False)
+    return result
+
+
+def _build_cached_url(source, quality, cache, stale):
+    return {
+        'code': 0,
+        'msg': 'success',
+        'data': cache['url'],
+        'extra': {
+            'cache': True,
+            # 缓存已超过可用时间，链接仍在实际有效期内
+            'stale': stale,
+            'quality': {
+                'target': quality,
+                'result': quality,
+            },
+            'expire': {
+                # 在更新缓存的时候把有效期的75%作为链接可用时长，现在加回来
+                'time': int(cache['time'] + (sourceExpirationTime[source]['time'] * 0.25)) if cache['expire'] else None,
+                'canExpire': cache['expire'],
+            }
+        },
+    }
+
+async def _fetch_lyric(func, source, songId):
+    start_time = time.perf_counter()
+    result = await breaker.call(source, lambda: func(songId))
+    await config.updateCacheAsync('lyric', f'{source}_{songId}', {
+        "data": result,
+        "time": int(time.time() + (86400 * 3)), # 歌词缓存3天
+        "expire": True,
+        "delta": round(time.perf_counter() - start_time, 3),
+    })
+    logger.debug(f'缓存已更新：{source}_{songId}, lyric: {result}')
+    return result
+
+
+async def _refresh_lyric(source, songId):
+    func = _require(source, 'lyric')
+    await coalesce('lyric', f'{source}_{songId}', lambda: _fetch_lyric(func, source, songId))
+
+
 async def lyric(source, songId, _, query):
-    cache = config.getCache('lyric', f'{source}_{songId}')
+    cache = await config.getCacheAsync('lyric', f'{source}_{songId}', allow_stale = True)
+    stale = None
     if cache:
-        return {
-            'code': 0,
-            'msg': 'success',
-            'data': cache['data']
-        }
+        state = _cache_state(cache)
+        if (state != 'stale'):
+            _stats('lyric')['hit'] += 1
+            if (state == 'revalidate'):
+                _spawn(_revalidate('lyric', f'{source}_{songId}', lambda: _refresh_lyric(source, songId)))
+            return {
+                'code': 0,
+                'msg': 'success',
+                'data': cache['data']
+            }
+        stale = cache
     try:
-        func = require('modules.' + source + '.lyric')
+        func = _require(source, 'lyric')
     except:
         return {
             'code': 1,
@@ -144,19 +571,26 @@ async def lyric(source, songId, _, query):
             'data': None,
         }
     try:
-        result = await func(songId)
-        config.updateCache('lyric', f'{source}_{songId}', {
-            "data": result,
-            "time": int(time.time() + (86400 * 3)), # 歌词缓存3天
-            "expire": True,
-        })
-        logger.debug(f'缓存已更新：{source}_{songId}, lyric: {result}')
+        result = await coalesce('lyric', f'{source}_{songId}', lambda: _fetch_lyric(func, source, songId))
         return {
             'code': 0,
             'msg': 'success',
             'data': result
         }
-    except FailedException as e:
+    except Exception as e:
+        if (stale):
+            logger.info(f'获取{source}_{songId}的歌词失败，返回已过期的缓存，原因：{e}')
+            return {
+                'code': 0,
+                'msg': 'success',
+                'data': stale['data'],
+                'extra': {
+                    'cache': True,
+                    'stale': True,
+                },
+            }
+        if (not isinstance(e, FailedException)):
+            raise
         return {
             'code': 2,
             'msg': e.args[0],
@@ -165,7 +599,7 @@ async def lyric(source, songId, _, query):
 
 async def search(source, songid, _, query):
     try:
-        func = require('modules.' + source + '.search')
+        func = _require(source, 'search')
     except:
         return {
             'code': 1,
@@ -188,7 +622,10 @@ async def search(source, songid, _, query):
 
 async def other(method, source, songid, _, query):
     try:
-        func = require('modules.' + source + '.' + method)
+        if (method.startswith('_') or (method == 'init')):
+            # 平台包内部的函数与初始化钩子不作为接口
+            raise AttributeError(method)
+        func = _require(source, method)
     except:
         return {
             'code': 1,
@@ -196,7 +633,7 @@ async def other(method, source, songid, _, query):
             'data': None,
         }
     try:
-        result = await func(songid)
+        result = await coalesce(method, f'{source}_{songid}', lambda: breaker.call(source, lambda: func(songid)))
         return {
             'code': 0,
             'msg': 'success',
@@ -210,4 +647,7 @@ async def other(method, source, songid, _, query):
         }
 
 async def info_with_query(source, songid, _, query):
-    return await other('info', source, songid, None)
\ No newline at end of file
+    return await other('info', source, songid, None, query)
+
+
+scheduler.append('refresh_ahead', _refresh_ahead, 10, silent = True)
@@ -84,4 +84,9 @@ async def search(type, params):
     if (type == 'song'):
         return await _songsearch(**params)
     else:
-        raise FailedException('暂不支持该类型搜索')
\ No newline at end of file
+        raise FailedException('暂不支持该类型搜索')
+
+def init():
+    # 平台被引入时由modules调用一次，注册定时任务
+    lite_signin.task_handler()
+    refresh_login.init()
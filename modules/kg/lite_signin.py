@@ -146,7 +146,7 @@ def task_handler():
         # add signin schedule task
         for user in pool:
             if (user.get('lite_sign_in').get('enable')):
-                scheduler.append(f'kugou_lite_sign_in_{user["userid"]}', do_account_signin, user['lite_sign_in']['interval'], {'user_info': user})
+                scheduler.append(f'kugou_lite_sign_in_{user["userid"]}', do_account_signin, user['lite_sign_in']['interval'], {'user_info': user}, leader_only = True)
     else:
         user_info = config.read_config('module.kg.user')
         if (user_info.get('lite_sign_in') is None):
@@ -163,6 +163,4 @@ def task_handler():
             logger.info('用户配置缺失lite_sign_in字段，已自动写入')
         
         if (user_info.get('lite_sign_in').get('enable')):
-            scheduler.append(f'kugou_lite_sign_in', do_account_signin, user_info['lite_sign_in']['interval'], {'user_info': user_info})
-
-task_handler()
+            scheduler.append(f'kugou_lite_sign_in', do_account_signin, user_info['lite_sign_in']['interval'], {'user_info': user_info}, leader_only = True)
@@ -6,9 +6,8 @@
 # - license: MIT - 
 # ----------------------------------------
 # This file is part of the "lx-music-api-server" project.
-import random
 from common.exceptions import FailedException
-from common import config, utils, variable
+from common import utils, cookiepool
 from .utils import getKey, signRequest, tools
 from .musicInfo import getMusicInfo
 import time
@@ -26,7 +25,8 @@ async def url(songId, quality):
     if (not albumaudioid):
         albumaudioid = ""
     thash = thash.lower()
-    user_info = config.read_config('module.kg.user') if (not variable.use_cookie_pool) else random.choice(config.read_config('module.cookiepool.kg'))
+    lease = cookiepool.acquire('kg')
+    user_info = lease.user
     params = {
         'album_id': albumid,
         'userid': user_info['userid'],
@@ -64,15 +64,17 @@ async def url(songId, quality):
         }
     if (tools['x-router']['enable']):
         headers['x-router'] = tools['x-router']['value']
-    req = await signRequest(tools.url, params, {'headers': headers})
-    body = req.json()
+    with lease:
+        req = await signRequest(tools.url, params, {'headers': headers})
+        body = req.json()
 
-    if body['status'] == 3:
-        raise FailedException('该歌曲在酷狗没有版权，请换源播放')
-    elif body['status'] == 2:
-        raise FailedException('链接获取失败，请检查账号是否有会员或数字专辑是否购买')
-    elif body['status'] != 1:
-        raise FailedException('链接获取失败，可能是数字专辑或者api失效')
+        if body['status'] == 3:
+            lease.neutral()
+            raise FailedException('该歌曲在酷狗没有版权，请换源播放', reason = 'no_copyright')
+        elif body['status'] == 2:
+            raise FailedException('链接获取失败，请检查账号是否有会员或数字专辑是否购买')
+        elif body['status'] != 1:
+            raise FailedException('链接获取失败，可能是数字专辑或者api失效')
 
     return {
         'url': body["url"][0],
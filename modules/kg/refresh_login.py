@@ -103,18 +103,6 @@ async def refresh():
             logger.info(f'为酷狗音乐账号(UID_{user_id})数据更新完毕')
             return
 
-if (not variable.use_cookie_pool):
-    kgconfig = config.read_config('module.kg')
-    refresh_login_info = kgconfig.get('refresh_login')
-    if (refresh_login_info):
-        kgconfig['user']['refresh_login'] = refresh_login_info
-        kgconfig.pop('refresh_login')
-        config.write_config('module.kg', kgconfig)
-
-if (config.read_config('module.kg.user.refresh_login.enable') and not variable.use_cookie_pool):
-    scheduler.append('kg_refresh_login', refresh,
-                     config.read_config('module.kg.user.refresh_login.interval'))
-
 async def refresh_login_for_pool(user_info):
     user_id = user_info["userid"]
     token = user_info["token"]
@@ -203,7 +191,21 @@ def reg_refresh_login_pool_task():
     for user_info in user_info_pool:
         if (user_info['refresh_login'].get('enable')):
             scheduler.append(
-                f'kgmusic_refresh_login_pooled_{user_info["userid"]}', refresh_login_for_pool, int(604800), args = {'user_info': user_info})
+                f'kgmusic_refresh_login_pooled_{user_info["userid"]}', refresh_login_for_pool, int(604800), args = {'user_info': user_info}, leader_only = True)
 
-if (variable.use_cookie_pool):
-    reg_refresh_login_pool_task()
+def init():
+    '''
+    迁移旧版本的配置并注册刷新登录的定时任务，在平台被引入时调用一次
+    '''
+    if (variable.use_cookie_pool):
+        reg_refresh_login_pool_task()
+        return
+    kgconfig = config.read_config('module.kg')
+    refresh_login_info = kgconfig.get('refresh_login')
+    if (refresh_login_info):
+        kgconfig['user']['refresh_login'] = refresh_login_info
+        kgconfig.pop('refresh_login')
+        config.write_config('module.kg', kgconfig)
+    if (config.read_config('module.kg.user.refresh_login.enable')):
+        scheduler.append('kg_refresh_login', refresh,
+                         config.read_config('module.kg.user.refresh_login.interval'), leader_only = True)
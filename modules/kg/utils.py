@@ -61,6 +61,9 @@ def sign(params, body = "", signkey = tools["signkey"]):
 async def signRequest(url, params, options, signkey = tools["signkey"]):
     params['signature'] = sign(params, options.get("body") if options.get("body") else (options.get("data") if options.get("data") else (options.get("json") if options.get("json") else "")), signkey)
     url = url + "?" + buildRequestParams(params)
+    if (options.get('method', 'GET').upper() == 'GET'):
+        # 登录等POST请求不能重复发送，只有GET请求开启重试与对冲
+        options.setdefault('idempotent', True)
     return await Httpx.AsyncRequest(url, options)
 
 def getKey(hash_, user_info):
@@ -7,10 +7,8 @@
 # ----------------------------------------
 # This file is part of the "lx-music-api-server" project.
 
-import random
 from common import Httpx
-from common import config
-from common import variable
+from common import cookiepool
 from common.exceptions import FailedException
 from . import refresh_login # 删了这个定时任务会寄掉
 
@@ -36,28 +34,34 @@ async def url(songmid, quality):
     infobody = info_request.json()
     if infobody["code"] != "000000":
         raise FailedException("failed to fetch song info")
-    user_info = config.read_config('module.mg.user') if (not variable.use_cookie_pool) else random.choice(config.read_config('module.cookiepool.mg'))
-    req = await Httpx.AsyncRequest(f'https://m.music.migu.cn/migumusic/h5/play/auth/getSongPlayInfo?type={tools["qualityMap"][quality]}&copyrightId={infobody["resource"][0]["copyrightId"]}', {
-        'method': 'GET',
-        'headers': {
-            'User-Agent': user_info['useragent'],
-            "by": user_info["by"],
-            "Cookie": "SESSION=" + user_info["session"],
-            "Referer": "https://m.music.migu.cn/v4/",
-            "Origin": "https://m.music.migu.cn",
-        },
-    })
-    try:
-        body = req.json()
+    lease = cookiepool.acquire('mg')
+    user_info = lease.user
+    with lease:
+        req = await Httpx.AsyncRequest(f'https://m.music.migu.cn/migumusic/h5/play/auth/getSongPlayInfo?type={tools["qualityMap"][quality]}&copyrightId={infobody["resource"][0]["copyrightId"]}', {
+            'method': 'GET',
+            'headers': {
+                'User-Agent': user_info['useragent'],
+                "by": user_info["by"],
+                "Cookie": "SESSION=" + user_info["session"],
+                "Referer": "https://m.music.migu.cn/v4/",
+                "Origin": "https://m.music.migu.cn",
+            },
+        })
+        try:
+            body = req.json()
 
-        if (int(body['code']) != 200 or (not body.get("data")) or (not body["data"]["playUrl"])):
-            raise FailedException(body.get("msg") if body.get("msg") else "failed")
+            if (int(body['code']) != 200 or (not body.get("data")) or (not body["data"]["playUrl"])):
+                raise FailedException(body.get("msg") if body.get("msg") else "failed")
 
-        data = body["data"]
+            data = body["data"]
 
-        return {
-            'url': body["data"]["playUrl"].split("?")[0] if body["data"]["playUrl"].split("?")[0].startswith("http") else "http:" + body["data"]["playUrl"].split("?")[0],
-            'quality': tools['qualityMapReverse'].get(data['formatId']) if (tools['qualityMapReverse'].get(data['formatId'])) else "unknown",
-        }
-    except:
-        raise FailedException('failed')
+            return {
+                'url': body["data"]["playUrl"].split("?")[0] if body["data"]["playUrl"].split("?")[0].startswith("http") else "http:" + body["data"]["playUrl"].split("?")[0],
+                'quality': tools['qualityMapReverse'].get(data['formatId']) if (tools['qualityMapReverse'].get(data['formatId'])) else "unknown",
+            }
+        except:
+            raise FailedException('failed')
+
+def init():
+    # 平台被引入时由modules调用一次，注册定时任务
+    refresh_login.init()
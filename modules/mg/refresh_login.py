@@ -35,17 +35,21 @@ async def do_account_refresh(user_info):
         raise FailedException("咪咕session保活失败: " + str(body["msg"]))
     return logger.info("咪咕session保活成功")
 
-if (variable.use_cookie_pool):
-    users = config.read_config("module.cookiepool.mg")
-    for u in users:
-        ref = u.get("refresh_login") if u.get("refresh_login") else {
-            "enable": False,
-            "interval": 86400
-        }
+def init():
+    '''
+    注册session保活的定时任务，在平台被引入时调用一次
+    '''
+    if (variable.use_cookie_pool):
+        users = config.read_config("module.cookiepool.mg")
+        for u in users:
+            ref = u.get("refresh_login") if u.get("refresh_login") else {
+                "enable": False,
+                "interval": 86400
+            }
+            if (ref["enable"]):
+                scheduler.append("migu_refresh_login_pooled_" + u["by"], do_account_refresh, ref["interval"], {"user_info": u}, leader_only = True)
+    else:
+        u = config.read_config("module.mg.user")
+        ref = config.read_config("module.mg.user.refresh_login")
         if (ref["enable"]):
-            scheduler.append("migu_refresh_login_pooled_" + u["by"], do_account_refresh, ref["interval"], {"user_info": u})
-else:
-    u = config.read_config("module.mg.user")
-    ref = config.read_config("module.mg.user.refresh_login")
-    if (ref["enable"]):
-        scheduler.append("migu_refresh_login", do_account_refresh, ref["interval"], {"user_info": u})
+            scheduler.append("migu_refresh_login", do_account_refresh, ref["interval"], {"user_info": u}, leader_only = True)
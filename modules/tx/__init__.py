@@ -81,4 +81,8 @@ async def lyric(songId):
     return await _getLyric(songId)
 
 async def mv(vid):
-    return await _getMvInfo(vid)
\ No newline at end of file
+    return await _getMvInfo(vid)
+
+def init():
+    # 平台被引入时由modules调用一次，注册定时任务
+    refresh_login.init()
@@ -235,7 +235,7 @@ async def getLyric(songId):
                 "type": -1,
             }
         }
-    })
+    }, idempotent = True)
     body = req.json()
     if ((body['code'] != 0) or (body['req']['code'] != 0)):
         raise FailedException('歌词获取失败')
@@ -27,7 +27,7 @@ async def getMusicInfo(songid):
             },
         },
     }
-    infoRequest = await signRequest(infoReqBody, True)
+    infoRequest = await signRequest(infoReqBody, True, idempotent = True)
     infoBody = infoRequest.json()
     if (infoBody['code'] != 0 or infoBody['req']['code'] != 0):
         raise FailedException("获取音乐信息失败")
@@ -8,11 +8,10 @@
 # This file is part of the "lx-music-api-server" project.
 
 from common.exceptions import FailedException
-from common import config, utils, variable, Httpx
+from common import config, utils, Httpx, cookiepool
 from .musicInfo import getMusicInfo
 from .utils import tools
 from .utils import signRequest
-import random
 
 createObject = utils.CreateObject
 
@@ -26,7 +25,7 @@ async def vkeyUrl(i, q, b):
     filename = b['track_info']['file']['media_mid']
     if (q in index_map.keys()):
         filename = b['track_info']['vs'][index_map[q]]
-    if (not filename): raise FailedException('未找到该音质')
+    if (not filename): raise FailedException('未找到该音质', reason = 'quality')
     filename = f"{tools.fileInfo[q]['h']}{filename}{tools.fileInfo[q]['e']}"
     src = f"{tools.fileInfo[q]['h']}{i}{tools.fileInfo[q]['e']}"
     url = apiNode + f'?filename={filename}&guid={config.read_config("module.tx.vkeyserver.guid")}&uin={config.read_config("module.tx.vkeyserver.uin")}&src={src}'
@@ -44,7 +43,8 @@ async def url(songId, quality):
     strMediaMid = infoBody['track_info']['file']['media_mid']
     if (config.read_config("module.tx.vkey_api.use_vkey_api")):
         return await vkeyUrl(songId, quality, infoBody)
-    user_info = config.read_config('module.tx.user') if (not variable.use_cookie_pool) else random.choice(config.read_config('module.cookiepool.tx'))
+    lease = cookiepool.acquire('tx')
+    user_info = lease.user
     requestBody = {
         'req_0': {
             'module': 'vkey.GetVkeyServer',
@@ -67,13 +67,16 @@ async def url(songId, quality):
             "v": "2010101"
         },
     }
-    req = await signRequest(requestBody)
-    body = createObject(req.json())
-    data = body.req_0.data.midurlinfo[0]
-    url = data['purl']
+    with lease:
+        req = await signRequest(requestBody)
+        body = createObject(req.json())
+        data = body.req_0.data.midurlinfo[0]
+        url = data['purl']
 
-    if (not url):
-        raise FailedException('failed')
+        if (not url):
+            # 歌曲或音质不可用，与账号状态无关
+            lease.neutral()
+            raise FailedException('failed')
 
     resultQuality = data['filename'].split('.')[0][:4]
 
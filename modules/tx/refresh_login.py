@@ -102,19 +102,6 @@ async def refresh():
     else:
         logger.error('未知的qqmusic_key格式')
 
-if (not variable.use_cookie_pool):
-    # changed refresh login config path
-    txconfig = config.read_config('module.tx')
-    refresh_login_info = txconfig.get('refresh_login')
-    if (refresh_login_info):
-        txconfig['user']['refresh_login'] = refresh_login_info
-        txconfig.pop('refresh_login')
-        config.write_config('module.tx', txconfig)
-
-if (config.read_config('module.tx.user.refresh_login.enable') and not variable.use_cookie_pool):
-    scheduler.append('qqmusic_refresh_login', refresh,
-                     config.read_config('module.tx.user.refresh_login.interval'))
-
 async def refresh_login_for_pool(user_info):
     if (user_info['qqmusic_key'].startswith('W_X')):
         options = {
@@ -205,8 +192,22 @@ def reg_refresh_login_pool_task():
     for user_info in user_info_pool:
         if (user_info['refresh_login'].get('enable')):
             scheduler.append(
-                f'qqmusic_refresh_login_pooled_{user_info["uin"]}', refresh_login_for_pool, user_info['refresh_login']['interval'], args = {'user_info': user_info})
+                f'qqmusic_refresh_login_pooled_{user_info["uin"]}', refresh_login_for_pool, user_info['refresh_login']['interval'], args = {'user_info': user_info}, leader_only = True)
 
-
-if (variable.use_cookie_pool):
-    reg_refresh_login_pool_task()
+def init():
+    '''
+    迁移旧版本的配置并注册刷新登录的定时任务，在平台被引入时调用一次
+    '''
+    if (variable.use_cookie_pool):
+        reg_refresh_login_pool_task()
+        return
+    # changed refresh login config path
+    txconfig = config.read_config('module.tx')
+    refresh_login_info = txconfig.get('refresh_login')
+    if (refresh_login_info):
+        txconfig['user']['refresh_login'] = refresh_login_info
+        txconfig.pop('refresh_login')
+        config.write_config('module.tx', txconfig)
+    if (config.read_config('module.tx.user.refresh_login.enable')):
+        scheduler.append('qqmusic_refresh_login', refresh,
+                         config.read_config('module.tx.user.refresh_login.interval'), leader_only = True)
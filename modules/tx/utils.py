@@ -53,7 +53,7 @@ tools = createObject({
     "cdnaddr": config.read_config("module.tx.cdnaddr") if config.read_config("module.tx.cdnaddr") else 'http://ws.stream.qqmusic.qq.com/',
 })
 
-async def signRequest(data, cache = False):
+async def signRequest(data, cache = False, idempotent = False):
     data = json.dumps(data)
     s = sign(data)
     headers = {}
@@ -61,7 +61,9 @@ async def signRequest(data, cache = False):
         'method': 'POST',
         'body': data,
         'headers': headers,
-        "cache": (86400 * 30) if cache else "no-cache"
+        "cache": (86400 * 30) if cache else "no-cache",
+        # 只有不使用账号的查询可以重试与对冲，使用账号的请求重复发送会增加账号的风控风险
+        "idempotent": idempotent,
     })
 
 def formatSinger(singerList):
@@ -7,9 +7,7 @@
 # ----------------------------------------
 # This file is part of the "lx-music-api-server" project.
 
-import random
-from common import Httpx, variable
-from common import config
+from common import Httpx, cookiepool
 from common.exceptions import FailedException
 from .encrypt import eapiEncrypt
 import ujson as json
@@ -55,22 +53,28 @@ async def url(songId, quality):
     }
     if (quality == "sky"):
         requestBody["immerseType"] = "c51"
-    req = await Httpx.AsyncRequest(requestUrl, {
-        'method': 'POST',
-        'headers': {
-            'Cookie': config.read_config('module.wy.user.cookie') if (not variable.use_cookie_pool) else random.choice(config.read_config('module.cookiepool.wy'))['cookie'],
-        },
-        'form': eapiEncrypt(path, json.dumps(requestBody))
-    })
-    body = req.json()
-    if (not body.get("data") or (not body.get("data")) or (not body.get("data")[0].get("url"))):
-        raise FailedException("failed")
+    lease = cookiepool.acquire('wy')
+    with lease:
+        req = await Httpx.AsyncRequest(requestUrl, {
+            'method': 'POST',
+            'headers': {
+                'Cookie': lease.user['cookie'],
+            },
+            'form': eapiEncrypt(path, json.dumps(requestBody))
+        })
+        body = req.json()
+        if (not body.get("data") or (not body.get("data")) or (not body.get("data")[0].get("url"))):
+            raise FailedException("failed")
 
     data = body["data"][0]
     if (data['level'] != tools['qualityMap'][quality]):
-        raise FailedException("reject unmatched quality")
+        raise FailedException("reject unmatched quality", reason = "quality")
 
     return {
         'url': data["url"].split("?")[0],
         'quality': tools['qualityMapReverse'][data['level']] 
     }
+
+def init():
+    # 平台被引入时由modules调用一次，注册定时任务
+    refresh_login.init()
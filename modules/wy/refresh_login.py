@@ -84,17 +84,21 @@ async def refresh(cookie:str):
         raise FailedException("网易云刷新登录失败(code: " + body["code"] + ")")
     return logger.info("网易云刷新登录成功")
 
-if (variable.use_cookie_pool):
-    cookies = config.read_config("module.cookiepool.wy")
-    for c in cookies:
-        ref = c.get("refresh_login") if c.get("refresh_login") else {
-            "enable": False,
-            "interval": 86400
-        }
+def init():
+    '''
+    注册刷新登录的定时任务，在平台被引入时调用一次
+    '''
+    if (variable.use_cookie_pool):
+        cookies = config.read_config("module.cookiepool.wy")
+        for c in cookies:
+            ref = c.get("refresh_login") if c.get("refresh_login") else {
+                "enable": False,
+                "interval": 86400
+            }
+            if (ref["enable"]):
+                scheduler.append("wy_refresh_login_pooled_" + c["cookie"][:32], refresh, ref["interval"], {"cookie": c["cookie"]}, leader_only = True)
+    else:
+        c = config.read_config("module.wy.user.cookie")
+        ref = config.read_config("module.wy.user.refresh_login")
         if (ref["enable"]):
-            scheduler.append("wy_refresh_login_pooled_" + c["cookie"][:32], refresh, ref["interval"], {"cookie": c["cookie"]})
-else:
-    c = config.read_config("module.wy.user.cookie")
-    ref = config.read_config("module.wy.user.refresh_login")
-    if (ref["enable"]):
-        scheduler.append("wy_refresh_login", refresh, ref["interval"], {"cookie": c})
\ No newline at end of file
+            scheduler.append("wy_refresh_login", refresh, ref["interval"], {"cookie": c}, leader_only = True)